@@ -0,0 +1,64 @@
+'''
+times ContractDetailsAirdrop.airdrop() on a seeded contract, everything is rolled back:
+
+python airdrop_benchmark.py [addresses] [addresses per message]
+'''
+import sys
+import time
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ducx_wish.settings')
+import django
+
+django.setup()
+
+from django.db import transaction, connection
+from django.contrib.auth.models import User
+
+from ducx_wish.contracts.models import Contract, ContractDetailsAirdrop, AirdropAddress
+from ducx_wish.deploy.models import Network
+
+
+def seed(count):
+    user, _ = User.objects.get_or_create(username='airdrop-benchmark')
+    contract = Contract.objects.create(
+        user=user, network=Network.objects.first(), contract_type=8, cost=0, state='ACTIVE'
+    )
+    details = ContractDetailsAirdrop.objects.create(
+        contract=contract, admin_address='0x' + '1' * 40, token_address='0x' + '2' * 40
+    )
+    AirdropAddress.objects.bulk_create([
+        AirdropAddress(contract=contract, address='0x%040x' % i, amount=10 ** 18 + i % 7)
+        for i in range(count)
+    ], batch_size=5000)
+    return details
+
+
+def run(details, status, rows, per_message):
+    queries = len(connection.queries)
+    started = time.time()
+    for i in range(0, len(rows), per_message):
+        details.airdrop({'status': status, 'airdroppedAddresses': [
+            {'address': address, 'value': str(amount)} for address, amount in rows[i:i + per_message]
+        ]})
+    print('{status}: {messages} messages in {seconds:.3f} s, {queries} queries'.format(
+        status=status, messages=(len(rows) + per_message - 1) // per_message,
+        seconds=time.time() - started, queries=len(connection.queries) - queries
+    ), flush=True)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_message = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    connection.force_debug_cursor = True
+    with transaction.atomic():
+        started = time.time()
+        details = seed(count)
+        print('seeded', count, 'addresses in {:.3f} s'.format(time.time() - started), flush=True)
+        rows = [(address, int(amount)) for address, amount in details.contract.airdropaddress_set.values_list(
+            'address', 'amount'
+        )]
+        run(details, 'PENDING', rows, per_message)
+        run(details, 'COMMITTED', rows, per_message)
+        print('contract state', details.contract.state, flush=True)
+        transaction.set_rollback(True)
@@ -1,5 +1,6 @@
 import time
-import pika
+import heapq
+import itertools
 import os
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ducx_wish.settings')
@@ -8,112 +9,160 @@ import django
 django.setup()
 
 from django.utils import timezone
-from django.core.mail import send_mail
+from django.db import transaction, connection
+from django.db.models import Q
 
-from ducx_wish.contracts.models import Contract
+from ducx_wish.contracts.models import ContractDetailsLastwill, LastwillReminder
 from ducx_wish.parint import *
+from ducx_wish.publisher import publish_contract_message
+from ducx_wish.other.mail_templates import queue_notifications, get_users_langs
 from ducx_wish.settings import DEFAULT_FROM_EMAIL, LASTWILL_ALIVE_TIMEOUT
-import email_messages
 import datetime
 
 
-def check_all():
-    print('check_all method', flush=True)
-    for contract in Contract.objects.filter(
-            contract_type__in=(0, 1, 2, 18, 19, 23), state='ACTIVE'
-    ):
-        print('contract_id=', contract.id, flush=True)
-        details = contract.get_details()
-        print('details_id=', details.id, flush=True)
-        if contract.contract_type == 2:
-            # if details.date < timezone.now():
-            #     send_in_pika(contract)
-            pass
-        elif contract.contract_type == 23:
-            print('days for execution', datetime.timedelta(seconds=
-                    details.end_timestamp - timezone.now().timestamp()).days, type(datetime.timedelta(seconds=
-                    details.end_timestamp - timezone.now().timestamp()).days), flush=True)
-
-            if datetime.timedelta(seconds=
-                    details.end_timestamp - timezone.now().timestamp()).days == 6 and not details.week_mail_sent:
-                try:
-                    details.execution_before_mail(7)
-                    print('week mail sent', flush=True)
-                except Exception as err:
-                    print('week mail failed', str(err), flush=True)
-            elif datetime.timedelta(seconds=
-                    details.end_timestamp - timezone.now().timestamp()).days == 0 and not details.day_mail_sent:
-                try:
-                    details.execution_before_mail(1)
-                    print('day mail sent', flush=True)
-                except Exception as err:
-                    print('day mail failed', str(err), flush=True)
-            if details.end_timestamp < timezone.now().timestamp():
-                try:
-                    details.execute_contract()
-                    print(contract.id, 'executed', flush=True)
-                except Exception as err:
-                    print(contract.id, 'execution failed', str(err), flush=True)
-        else:
+# days before next_check at which a reminder is sent
+REMINDER_DAYS = (10, 5, 1)
+REMINDER_INSERT_CHUNK = 5000
+
+# scheduled events: (due time, sequence, kind, details id)
+schedule = []
+counter = itertools.count()
+
+
+def schedule_event(when, kind, details_id):
+    heapq.heappush(schedule, (when, next(counter), kind, details_id))
+
+
+def remind_at(next_check, day):
+    # reminder for `day` is due once (next_check - now).days drops to `day`
+    return next_check - datetime.timedelta(days=day + 1)
+
+
+def record_reminders(reminders):
+    '''
+    inserts (details id, next_check, days) rows into the ledger, returns the ones
+    that were not there yet, rows written by a concurrent sweep are skipped
+    '''
+    table = LastwillReminder._meta.db_table
+    now = timezone.now()
+    inserted = set()
+    with connection.cursor() as cursor:
+        for i in range(0, len(reminders), REMINDER_INSERT_CHUNK):
+            chunk = reminders[i:i + REMINDER_INSERT_CHUNK]
+            cursor.execute(
+                'INSERT INTO {table} (details_id, next_check, days, created_at) VALUES {values} '
+                'ON CONFLICT DO NOTHING RETURNING details_id, next_check, days'.format(
+                    table=table, values=','.join(['(%s, %s, %s, %s)'] * len(chunk))
+                ),
+                [value for reminder in chunk for value in reminder + (now,)]
+            )
+            inserted.update(cursor.fetchall())
+    return inserted
+
+
+def send_reminders(window_end):
+    '''
+    queues the reminders due until window_end with one select and one insert,
+    reminders missed by a failed sweep are caught up while their day lasts,
+    the ledger skips the sent ones
+    '''
+    now = timezone.now()
+    horizon = window_end + datetime.timedelta(days=max(REMINDER_DAYS) + 1)
+    rows = ContractDetailsLastwill.objects.filter(
+        next_check__gt=now, next_check__lte=horizon, active_to__gt=window_end,
+        contract__state='ACTIVE', contract__contract_type__in=(0, 18, 19)
+    ).exclude(contract__user__email='').values_list('id', 'next_check', 'contract__user_id', 'contract__user__email')
+    sent = set(LastwillReminder.objects.filter(
+        next_check__gt=now, next_check__lte=horizon
+    ).values_list('details_id', 'next_check', 'days'))
+    reminders = {}
+    for details_id, next_check, user_id, email in rows:
+        # a reminder is late by less than a day at most, so a short check period
+        # does not get the 10 or 5 day reminders
+        due_days = [
+            day for day in REMINDER_DAYS
+            if remind_at(next_check, day) <= window_end and next_check - now >= datetime.timedelta(days=day)
+        ]
+        if not due_days:
+            continue
+        key = details_id, next_check, min(due_days)
+        if key not in sent:
+            reminders[key] = user_id, email
+    if not reminders:
+        return
+    langs = get_users_langs({user_id for user_id, _ in reminders.values()})
+    with transaction.atomic():
+        inserted = record_reminders(list(reminders))
+        queue_notifications('remind_subject', 'remind_message', DEFAULT_FROM_EMAIL, [
+            (reminders[key][1], langs[reminders[key][0]], {'days': key[2]}) for key in reminders if key in inserted
+        ])
+    print('reminders queued', len(inserted), flush=True)
+
+
+def load_due(window_start, window_end):
+    print('loading due contracts until', window_end, flush=True)
+    due = Q(active_to__lte=window_end) | Q(next_check__lte=window_end)
+    count = 0
+    for details in ContractDetailsLastwill.objects.filter(
+            due, contract__state='ACTIVE', contract__contract_type__in=(0, 18, 19)
+    ).only('id', 'active_to', 'next_check'):
+        count += 1
+        if details.active_to <= window_end:
+            schedule_event(details.active_to, 'expire', details.id)
+            continue
+        if details.next_check is None:
+            continue
+        if details.next_check <= window_end:
+            schedule_event(details.next_check, 'check', details.id)
+    print('due contracts', count, flush=True)
+
+
+def run_event(kind, details_id):
+    details = ContractDetailsLastwill.objects.select_related(
+        'contract', 'contract__network'
+    ).filter(id=details_id, contract__state='ACTIVE').first()
+    if details is None:
+        return
+    contract = details.contract
+    now = timezone.now()
+    print('contract_id=', contract.id, kind, flush=True)
+    if details.active_to < now:
+        contract.state = 'EXPIRED'
+        contract.save()
+    elif kind == 'check' and details.next_check and details.next_check <= now:
+        send_in_pika(contract)
+
+
+def sleep_until(when):
+    delay = (when - timezone.now()).total_seconds()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def run_scheduler():
+    window = datetime.timedelta(seconds=LASTWILL_ALIVE_TIMEOUT)
+    window_end = timezone.now()
+    while 1:
+        window_start, window_end = window_end, timezone.now() + window
+        load_due(window_start, window_end)
+        try:
+            send_reminders(window_end)
+        except Exception as err:
+            print('fail reminders', str(err), flush=True)
+        while schedule and schedule[0][0] <= window_end:
+            sleep_until(schedule[0][0])
+            when, _, kind, details_id = heapq.heappop(schedule)
             try:
-                if details.active_to < timezone.now():
-                    contract.state = 'EXPIRED'
-                    contract.save()
-                elif details.next_check and details.next_check <= timezone.now():
-                    send_in_pika(contract)
-                send_reminders(contract)
-            except:
-                print('fail', flush=True)
-    print('checked all', flush=True)
-
-
-def create_reminder(contract, day):
-    day = 1 if day <= 1 else day
-    print('{days} day message'.format(days=day), contract.id, flush=True)
-    send_mail(
-        email_messages.remind_subject,
-        email_messages.remind_message.format(days=day),
-        DEFAULT_FROM_EMAIL,
-        [contract.user.email]
-    )
-
-
-def send_reminders(contract):
-    if contract.contract_type in [0, 18, 19]:
-        details = contract.get_details()
-        if contract.state == 'ACTIVE' and contract.user.email:
-            if details.next_check:
-                now = timezone.now()
-                delta = details.next_check - now
-                if delta.days <= 1 or delta.days in {5, 10}:
-                    create_reminder(contract, delta.days)
+                run_event(kind, details_id)
+            except Exception as err:
+                print('fail', kind, details_id, str(err), flush=True)
+        sleep_until(window_end)
 
 
 def send_in_pika(contract):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        'localhost',
-        5672,
-        'ducxwill',
-        pika.PlainCredentials('ducxwill', 'ducxwill'),
-    ))
-    queue = NETWORKS[contract.network.name]['queue']
-    channel = connection.channel()
-    channel.queue_declare(queue=queue, durable=True,
-                          auto_delete=False,
-                          exclusive=False)
-    channel.basic_publish(
-        exchange='',
-        routing_key=queue,
-        body=json.dumps(
-            {'status': 'COMMITTED', 'contractId': contract.id}),
-        properties=pika.BasicProperties(type='check_contract'),
-    )
-    print('send check contract')
-    connection.close()
+    publish_contract_message(NETWORKS[contract.network.name]['queue'], contract.id, 'check_contract')
+    print('send check contract', flush=True)
 
 
 if __name__ == '__main__':
-    while 1:
-        check_all()
-        time.sleep(LASTWILL_ALIVE_TIMEOUT)
-        # time.sleep(60 * 10)
+    run_scheduler()
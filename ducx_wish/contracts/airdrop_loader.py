@@ -0,0 +1,161 @@
+import re
+import io
+import csv
+import json
+import binascii
+from decimal import Decimal, InvalidOperation
+
+from base58 import b58decode_check
+from django.db import connection, transaction
+
+from ducx_wish.consts import MAX_WEI_DIGITS
+from ducx_wish.settings import AIRDROP_LOAD_CHUNK, AIRDROP_LOAD_MAX_REJECTS
+from ducx_wish.contracts.submodels.airdrop import AirdropAddress
+
+
+TRON_NETWORKS = ('TRON_MAINNET', 'TRON_TESTNET')
+ETH_ADDRESS_RE = re.compile(r'^0x[0-9a-f]{40}$')
+TRON_HEX_ADDRESS_RE = re.compile(r'^41[0-9a-fA-F]{40}$')
+
+
+class AirdropLoadError(Exception):
+    pass
+
+
+def convert_airdrop_address_to_hex(address):
+    return binascii.hexlify(b58decode_check(address)).decode('utf-8')
+
+
+def normalize_airdrop_address(address, network_name):
+    address = address.strip()
+    if network_name in TRON_NETWORKS:
+        if address.startswith('0x'):
+            address = '41' + address[2:]
+        elif not address.startswith('41'):
+            try:
+                address = convert_airdrop_address_to_hex(address)
+            except ValueError:
+                raise AirdropLoadError('invalid base58 address')
+        if not TRON_HEX_ADDRESS_RE.match(address):
+            raise AirdropLoadError('invalid address')
+        return address
+    address = address.lower()
+    if not ETH_ADDRESS_RE.match(address):
+        raise AirdropLoadError('invalid address')
+    return address
+
+
+def normalize_airdrop_amount(amount):
+    try:
+        amount = Decimal(str(amount).strip())
+    except InvalidOperation:
+        raise AirdropLoadError('invalid amount')
+    # infinities and NaNs would pass or break the comparisons below
+    if not amount.is_finite():
+        raise AirdropLoadError('invalid amount')
+    if amount != amount.to_integral_value() or amount < 0 or len(str(int(amount))) > MAX_WEI_DIGITS:
+        raise AirdropLoadError('invalid amount')
+    return int(amount)
+
+
+def decode_lines(upload):
+    for line, raw in enumerate(upload, 1):
+        try:
+            yield raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise AirdropLoadError('line %d is not utf-8' % line)
+
+
+def iter_csv_rows(lines):
+    try:
+        for line, row in enumerate(csv.reader(lines), 1):
+            if not row or (line == 1 and row[0].strip().lower() == 'address'):
+                continue
+            if len(row) < 2:
+                yield line, {'address': row[0]}
+            else:
+                yield line, {'address': row[0], 'amount': row[1]}
+    except csv.Error as e:
+        raise AirdropLoadError('invalid csv: %s' % e)
+
+
+def iter_ndjson_rows(lines):
+    for line, raw in enumerate(lines, 1):
+        if not raw.strip():
+            continue
+        try:
+            yield line, json.loads(raw)
+        except ValueError:
+            yield line, None
+
+
+def iter_upload_rows(upload, fmt=None):
+    if not fmt:
+        fmt = 'ndjson' if upload.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+    lines = decode_lines(upload)
+    if fmt == 'csv':
+        return iter_csv_rows(lines)
+    if fmt == 'ndjson':
+        return iter_ndjson_rows(lines)
+    raise AirdropLoadError('unknown format %s' % fmt)
+
+
+def write_chunk(cursor, staging, chunk):
+    buf = io.StringIO(''.join('%s\t%s\n' % row for row in chunk))
+    cursor.copy_from(buf, staging, columns=('address', 'amount'))
+
+
+def load_airdrop_rows(contract, rows):
+    network_name = contract.network.name
+    table = AirdropAddress._meta.db_table
+    staging = 'airdrop_staging_%d' % contract.id
+    loaded = 0
+    rejected = 0
+    rejects = []
+    chunk = []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS {staging} '
+            '(address varchar(50), amount numeric({digits}, 0))'.format(staging=staging, digits=MAX_WEI_DIGITS)
+        )
+        cursor.execute('TRUNCATE {staging}'.format(staging=staging))
+        try:
+            for line, row in rows:
+                try:
+                    if not isinstance(row, dict) or 'address' not in row or 'amount' not in row:
+                        raise AirdropLoadError('address and amount required')
+                    chunk.append((
+                        normalize_airdrop_address(str(row['address']), network_name),
+                        normalize_airdrop_amount(row['amount'])
+                    ))
+                except AirdropLoadError as e:
+                    rejected += 1
+                    if len(rejects) < AIRDROP_LOAD_MAX_REJECTS:
+                        rejects.append({'line': line, 'error': str(e)})
+                    continue
+                if len(chunk) >= AIRDROP_LOAD_CHUNK:
+                    write_chunk(cursor, staging, chunk)
+                    loaded += len(chunk)
+                    chunk = []
+                    print('airdrop load contract', contract.id, 'staged', loaded, 'rejected', rejected, flush=True)
+            if chunk:
+                write_chunk(cursor, staging, chunk)
+                loaded += len(chunk)
+
+            with transaction.atomic():
+                if contract.airdropaddress_set.select_for_update().filter(
+                        state__in=('processing', 'sent')
+                ).exists():
+                    raise AirdropLoadError('airdrop already started')
+                cursor.execute('DELETE FROM {table} WHERE contract_id = %s'.format(table=table), [contract.id])
+                cursor.execute(
+                    'INSERT INTO {table} (contract_id, address, active, state, amount) '
+                    'SELECT %s, address, true, %s, amount FROM {staging}'.format(table=table, staging=staging),
+                    [contract.id, 'added']
+                )
+        finally:
+            cursor.execute('DROP TABLE IF EXISTS {staging}'.format(staging=staging))
+
+    print('airdrop load contract', contract.id, 'done, loaded', loaded, 'rejected', rejected, flush=True)
+    return {'loaded': loaded, 'rejected': rejected, 'rejects': rejects}
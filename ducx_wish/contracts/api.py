@@ -3,7 +3,7 @@ from os.path import join
 
 from django.http import Http404, JsonResponse
 from django.views.generic import View
-from django.core.mail import send_mail, EmailMessage
+from ducx_wish.other.models import queue_mail
 
 from rest_framework import status
 from rest_framework import viewsets
@@ -12,31 +12,41 @@ from rest_framework.permissions import BasePermission, SAFE_METHODS
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from collections import OrderedDict
 
 from ducx_wish.settings import BASE_DIR, ETHERSCAN_API_KEY, COINMARKETCAP_API_KEYS, NETWORKS
+from ducx_wish.settings import CONTRACTS_MAX_PAGE_SIZE, STATISTICS_CACHE_TIMEOUT, STATISTICS_REQUEST_TIMEOUT
 from ducx_wish.settings import DUCATUSX_URL, EMAIL_HOST_USER, DUCATUSX_CONFIRM_EMAIL, DEFAULT_FROM_EMAIL
 from ducx_wish.permissions import IsOwner, IsStaff, IsDucXAdmin
 from ducx_wish.profile.models import Profile
 from ducx_wish.contracts.models import Contract, WhitelistAddress, AirdropAddress, DUCXContract, send_in_queue, \
     ContractDetailsInvestmentPool, InvestAddress, CurrencyStatisticsCache
 from ducx_wish.deploy.models import Network
+from ducx_wish.contracts.decorators import memoize_timeout
 from ducx_wish.payments.api import create_payment, freeze_balance, unfreeze_balance
 from exchange_API import to_wish, convert
 from email_messages import authio_message, authio_subject, authio_google_subject, authio_google_message, \
     ducatus_admin_confirm_subject, ducatus_admin_confirm_ico_text, ducatus_admin_confirm_token_text
+from .airdrop_loader import AirdropLoadError, iter_upload_rows, load_airdrop_rows
 from .serializers import ContractSerializer, count_sold_tokens, WhitelistAddressSerializer, AirdropAddressSerializer
 from ducx_wish.consts import *
 import requests
-from django.db.models import Q
+from concurrent.futures import ThreadPoolExecutor
+from django.db.models import Q, Case, When, Value, BooleanField, Count
 
 BROWSER_HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:69.0) Geko/20100101 Firefox/69.0'}
 
 
+class ContractPagination(LimitOffsetPagination):
+    max_limit = CONTRACTS_MAX_PAGE_SIZE
+
+
 class ContractViewSet(ModelViewSet):
     queryset = Contract.objects.all()
     serializer_class = ContractSerializer
+    pagination_class = ContractPagination
     permission_classes = (IsAuthenticated, IsStaff | IsOwner | IsDucXAdmin)
 
     def destroy(self, request, *args, **kwargs):
@@ -50,7 +60,7 @@ class ContractViewSet(ModelViewSet):
         raise PermissionDenied()
 
     def get_queryset(self):
-        result = self.queryset.order_by('-created_date')
+        result = self.queryset.select_related('network').order_by('-created_date')
         host = self.request.META['HTTP_HOST']
         print('host is', host, flush=True)
         if host == DUCATUSX_URL:
@@ -198,7 +208,7 @@ def send_to_ducatus_admin(contract, request):
             confirm_url=contract_url
         )
 
-    send_mail(
+    queue_mail(
         mail_subject,
         mail_text,
         mail_from,
@@ -400,10 +410,11 @@ def get_new_currency_statistics():
     return answer
 
 
-def get_balances_statistics():
+def get_neo_balances():
     neo_info = json.loads(requests.get(
         URL_STATS_BALANCE['NEO'] +
-        '{address}'.format(address=NETWORKS['NEO_TESTNET']['address'])
+        '{address}'.format(address=NETWORKS['NEO_TESTNET']['address']),
+        timeout=STATISTICS_REQUEST_TIMEOUT
     ).content.decode())
     neo_balance = 0.0
     gas_balance = 0.0
@@ -412,19 +423,28 @@ def get_balances_statistics():
             gas_balance = curr['amount']
         if curr['asset'] == 'NEO':
             neo_balance = curr['amount']
-    eth_account_balance = float(json.loads(requests.get(url=
-                                                        URL_STATS_BALANCE[
-                                                            'ETH'] + '{address}&tag=latest&apikey={api_key}'.format(
-                                                            address=ETH_MAINNET_ADDRESS, api_key=ETHERSCAN_API_KEY),
-                                                        headers=BROWSER_HEADERS).content.decode())['result']) / \
-                          NET_DECIMALS['ETH']
-    eth_test_account_balance = float(json.loads(requests.get(url=
-                                                             URL_STATS_BALANCE[
-                                                                 'ETH_ROPSTEN'] + '{address}&tag=latest&apikey={api_key}'.format(
-                                                                 address=ETH_TESTNET_ADDRESS,
-                                                                 api_key=ETHERSCAN_API_KEY),
-                                                             headers=BROWSER_HEADERS).content.decode())['result']) / \
-                               NET_DECIMALS['ETH']
+    return neo_balance, gas_balance
+
+
+def get_etherscan_balance(url_name, address):
+    res = requests.get(
+        url=URL_STATS_BALANCE[url_name] + '{address}&tag=latest&apikey={api_key}'.format(
+            address=address, api_key=ETHERSCAN_API_KEY
+        ),
+        headers=BROWSER_HEADERS,
+        timeout=STATISTICS_REQUEST_TIMEOUT
+    )
+    return float(json.loads(res.content.decode())['result']) / NET_DECIMALS['ETH']
+
+
+def get_balances_statistics():
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        neo_future = executor.submit(get_neo_balances)
+        eth_future = executor.submit(get_etherscan_balance, 'ETH', ETH_MAINNET_ADDRESS)
+        eth_test_future = executor.submit(get_etherscan_balance, 'ETH_ROPSTEN', ETH_TESTNET_ADDRESS)
+        neo_balance, gas_balance = neo_future.result()
+        eth_account_balance = eth_future.result()
+        eth_test_account_balance = eth_test_future.result()
 
     eos_test_account_balance = 0
     eos_cpu_test_builder = 0
@@ -451,10 +471,24 @@ def get_balances_statistics():
 
 
 def get_ieo_statistics():
-    res = requests.get('https://www.bitforex.com/server/cointrade.act?cmd=getTicker&busitype=coin-btc-swap')
+    res = requests.get(
+        'https://www.bitforex.com/server/cointrade.act?cmd=getTicker&busitype=coin-btc-swap',
+        timeout=STATISTICS_REQUEST_TIMEOUT
+    )
     return res.json()
 
 
+@memoize_timeout(STATISTICS_CACHE_TIMEOUT)
+def get_external_statistics():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        balances_future = executor.submit(get_balances_statistics)
+        ieo_future = executor.submit(get_ieo_statistics)
+        return {
+            'balances_statistics': balances_future.result(),
+            'ieo': ieo_future.result()
+        }
+
+
 def get_usd_rub_rates():
     res = requests.get(url=URL_STATS_CURRENCY['RUB'], headers=BROWSER_HEADERS)
     rub_rate = {
@@ -465,52 +499,55 @@ def get_usd_rub_rates():
     return rub_rate
 
 
-def get_contracts_for_network(net, all_contracts, now, day):
-    contracts = all_contracts.filter(network=net)
-    new_contracts = contracts.filter(created_date__lte=now,
-                                     created_date__gte=day)
-    created = contracts.filter(state__in=['CREATED'])
-    now_created = created.filter(created_date__lte=now, created_date__gte=day)
-    active = contracts.filter(
-        state__in=['ACTIVE', 'WAITING', 'WAITING_ACTIVATION']
-    )
-    now_active = active.filter(created_date__lte=now, created_date__gte=day)
-    done = contracts.filter(
-        state__in=[
-            'DONE', 'CANCELLED', 'ENDED', 'EXPIRED',
-            'UNDER_CROWDSALE', 'TRIGGERED', 'KILLED'
-        ]
-    )
-    now_done = done.filter(created_date__lte=now, created_date__gte=day)
-    error = contracts.filter(state__in=['POSTPONED'])
-    now_error = error.filter(created_date__lte=now, created_date__gte=day)
-    in_progress = contracts.filter(state__in=['WAITING_FOR_DEPLOYMENT'])
-    now_in_progress = in_progress.filter(
-        created_date__lte=now, created_date__gte=day
-    )
-    answer = {
-        'contracts': len(contracts),
-        'new_contracts': len(new_contracts),
-        'active_contracts': len(active),
-        'created_contracts': len(created),
-        'done': len(done),
-        'error': len(error),
-        'now_created': len(now_created),
-        'now_active': len(now_active),
-        'now_done': len(now_done),
-        'now_error': len(now_error),
-        'launch': len(in_progress),
-        'now_launch': len(now_in_progress)
-    }
+# (total key, created today key, states)
+STATISTICS_STATE_GROUPS = (
+    ('created_contracts', 'now_created', ('CREATED',)),
+    ('active_contracts', 'now_active', ('ACTIVE', 'WAITING', 'WAITING_ACTIVATION')),
+    ('done', 'now_done', ('DONE', 'CANCELLED', 'ENDED', 'EXPIRED', 'UNDER_CROWDSALE', 'TRIGGERED', 'KILLED')),
+    ('error', 'now_error', ('POSTPONED',)),
+    ('launch', 'now_launch', ('WAITING_FOR_DEPLOYMENT',)),
+)
+
+
+def get_contracts_statistics(networks, all_contracts, now, day):
     contract_details_types = Contract.get_all_details_model()
-    for ctype in contract_details_types:
-        answer['contract_type_' + str(ctype)] = contracts.filter(
-            contract_type=ctype
-        ).count()
-        answer['contract_type_' + str(ctype) + '_new'] = contracts.filter(
-            contract_type=ctype
-        ).filter(created_date__lte=now, created_date__gte=day).count()
-    return answer
+    totals = {}
+    for network in networks:
+        answer = totals[network.id] = {
+            'contracts': 0, 'new_contracts': 0,
+            'active_contracts': 0, 'created_contracts': 0, 'done': 0, 'error': 0, 'launch': 0,
+            'now_created': 0, 'now_active': 0, 'now_done': 0, 'now_error': 0, 'now_launch': 0
+        }
+        for ctype in contract_details_types:
+            answer['contract_type_' + str(ctype)] = 0
+            answer['contract_type_' + str(ctype) + '_new'] = 0
+
+    rows = all_contracts.annotate(today=Case(
+        When(created_date__lte=now, created_date__gte=day, then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField()
+    )).values_list('network_id', 'state', 'contract_type', 'today').annotate(count=Count('id')).order_by()
+
+    state_keys = {state: (key, now_key) for key, now_key, states in STATISTICS_STATE_GROUPS for state in states}
+    for network_id, state, contract_type, today, count in rows:
+        answer = totals.get(network_id)
+        if answer is None:
+            continue
+        type_key = 'contract_type_' + str(contract_type)
+        answer['contracts'] += count
+        if state in state_keys:
+            answer[state_keys[state][0]] += count
+        if type_key in answer:
+            answer[type_key] += count
+        if not today:
+            continue
+        answer['new_contracts'] += count
+        if state in state_keys:
+            answer[state_keys[state][1]] += count
+        if type_key in answer:
+            answer[type_key + '_new'] += count
+
+    return {network.name: totals[network.id] for network in networks}
 
 
 @api_view(http_method_names=['GET'])
@@ -542,11 +579,10 @@ def get_statistics(request):
         fb_test_users = []
 
     answer = {
-        'user_statistics': {'users': len(users), 'new_users': len(new_users)},
+        'user_statistics': {'users': users.count(), 'new_users': new_users.count()},
         'currency_statistics': get_currency_statistics(),
-        'balances_statistics': get_balances_statistics(),
-        'ieo': get_ieo_statistics()
     }
+    answer.update(get_external_statistics())
     networks = Network.objects.all()
     contracts = Contract.objects.all().exclude(
         user__in=anonymous
@@ -557,10 +593,7 @@ def get_statistics(request):
     ).exclude(
         user__email__startswith='testermc'
     )
-    for network in networks:
-        answer[network.name] = get_contracts_for_network(
-            network, contracts, now, day
-        )
+    answer.update(get_contracts_statistics(networks, contracts, now, day))
 
     return JsonResponse(answer)
 
@@ -602,10 +635,10 @@ def get_statistics_landing(request):
         created_date__lte=now, created_date__gte=day
     )
     answer = {
-        'contracts': len(contracts),
-        'new_contracts': len(new_contracts),
-        'users': len(users),
-        'new_users': len(new_users)
+        'contracts': contracts.count(),
+        'new_contracts': new_contracts.count(),
+        'users': users.count(),
+        'new_users': new_users.count()
     }
     return JsonResponse(answer)
 
@@ -682,36 +715,24 @@ class AirdropAddressViewSet(viewsets.ModelViewSet):
         return result
 
 
-def convert_airdrop_address_to_hex(address):
-    # short_addresss = address[1:]
-    decode_address = base58.b58decode(address)[1:21]
-    hex_address = binascii.hexlify(decode_address)
-    hex_address = '41' + hex_address.decode("utf-8")
-    return hex_address
-
-
 @api_view(http_method_names=['POST'])
 def load_airdrop(request):
     contract = Contract.objects.get(id=request.data.get('id'))
     if contract.user != request.user or contract.contract_type not in [8, 13, 17] or contract.state != 'ACTIVE':
         raise PermissionDenied
     if contract.network.name not in ['EOS_MAINNET', 'EOS_TESTNET']:
-        if contract.airdropaddress_set.filter(state__in=('processing', 'sent')).count():
+        if contract.airdropaddress_set.filter(state__in=('processing', 'sent')).exists():
             raise PermissionDenied
-        contract.airdropaddress_set.all().delete()
-        addresses = request.data.get('addresses')
-        if contract.network.name in ['TRON_MAINNET', 'TRON_TESTNET']:
-            for x in addresses:
-                if x['address'].startswith('0x'):
-                    x['address'] = '41' + x['address'][2:]
-                else:
-                    if not x['address'].startswith('41'):
-                        x['address'] = convert_airdrop_address_to_hex(x['address'])
-        AirdropAddress.objects.bulk_create([AirdropAddress(
-            contract=contract,
-            address=x['address'] if contract.network.name in ['TRON_MAINNET', 'TRON_TESTNET'] else x['address'].lower(),
-            amount=x['amount']
-        ) for x in addresses])
+        upload = request.FILES.get('file')
+        try:
+            if upload is not None:
+                rows = iter_upload_rows(upload, request.data.get('format'))
+            else:
+                rows = enumerate(request.data.get('addresses') or [], 1)
+            result = load_airdrop_rows(contract, rows)
+        except AirdropLoadError as e:
+            raise ValidationError({'result': str(e)})
+        return JsonResponse(dict(result='ok', **result))
     else:
         if contract.eosairdropaddress_set.filter(state__in=('processing', 'sent')).count():
             raise PermissionDenied
@@ -785,9 +806,9 @@ def send_authio_info(contract, details, authio_email):
         if th.freeze_date:
             mint_info = mint_info + str(
                 datetime.datetime.utcfromtimestamp(th.freeze_date).strftime('%Y-%m-%d %H:%M:%S')) + '\n'
-    EmailMessage(
-        subject=authio_subject,
-        body=authio_message.format(
+    queue_mail(
+        authio_subject,
+        authio_message.format(
             address=details.ducx_contract_token.address,
             email=authio_email,
             token_name=details.token_name,
@@ -797,10 +818,10 @@ def send_authio_info(contract, details, authio_email):
             mint_info=mint_info if mint_info else 'No',
             admin_address=details.admin_address
         ),
-        from_email=DEFAULT_FROM_EMAIL,
-        to=[AUTHIO_EMAIL, SUPPORT_EMAIL]
-    ).send()
-    send_mail(
+        DEFAULT_FROM_EMAIL,
+        [AUTHIO_EMAIL, SUPPORT_EMAIL]
+    )
+    queue_mail(
         authio_google_subject,
         authio_google_message,
         DEFAULT_FROM_EMAIL,
@@ -2,9 +2,9 @@ import sys, traceback
 import time
 
 from django.db.models import Q
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 
-from ducx_wish.deploy.models import DeployAddress
+from ducx_wish.deploy.helpers import lock_deploy_address, deploy_addresses
 from ducx_wish.settings import DEFAULT_FROM_EMAIL, EMAIL_FOR_POSTPONED_MESSAGE
 from ducx_wish.settings import NETWORKS
 from email_messages import *
@@ -46,7 +46,7 @@ def postponable(f):
         contract = args[0].contract
         if contract.state == 'POSTPONED':
             print('message rejected because contract postponed', flush=True)
-            send_mail(
+            queue_mail(
                 postponed_subject,
                 postponed_message.format(
                     contract_id=contract.id
@@ -61,7 +61,7 @@ def postponable(f):
         except Exception as e:
             contract.state = 'POSTPONED'
             contract.save()
-            send_mail(
+            queue_mail(
                 postponed_subject,
                 postponed_message.format(
                     contract_id=contract.id
@@ -70,10 +70,7 @@ def postponable(f):
                 [EMAIL_FOR_POSTPONED_MESSAGE]
             )
             print('contract postponed due to exception', flush=True)
-            address = NETWORKS[contract.network.name]['address']
-            take_off_blocking(
-                contract.network.name, contract_id=contract.id, address=address
-            )
+            take_off_blocking(contract.network.name, contract_id=contract.id)
             print('queue unlocked due to exception', flush=True)
             raise
     return wrapper
@@ -81,28 +78,24 @@ def postponable(f):
 
 def blocking(f):
     def wrapper(*args, **kwargs):
-        network_name = args[0].contract.network.name
-        address = NETWORKS[args[0].contract.network.name]['address']
-        if not DeployAddress.objects.select_for_update().filter(
-                Q(network__name=network_name) & Q(address=address) & (Q(locked_by__isnull=True) | Q(locked_by=args[0].contract.id))
-        ).update(locked_by=args[0].contract.id):
-            print('address locked. sleeping 5 and requeueing the message', flush=True)
-            time.sleep(5)
+        if not lock_deploy_address(args[0].contract):
+            print('all addresses locked, delaying the message', flush=True)
             raise NeedRequeue()
         return f(*args, **kwargs)
     return wrapper
 
 
 def take_off_blocking(network, contract_id=None, address=None):
-    if not address:
-        address = NETWORKS[network]['address']
     if not contract_id:
-        DeployAddress.objects.select_for_update().filter(
+        if not address:
+            address = NETWORKS[network]['address']
+        deploy_addresses().filter(
             network__name=network, address=address
         ).update(locked_by=None)
     else:
-        DeployAddress.objects.select_for_update().filter(
-            network__name=network, address=address, locked_by=contract_id
+        # the contract holds only the address it is deployed from
+        deploy_addresses().filter(
+            network__name=network, locked_by=contract_id
         ).update(locked_by=None)
 
 
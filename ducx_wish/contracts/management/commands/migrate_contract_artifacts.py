@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ducx_wish.contracts.models import *
+
+
+class Command(BaseCommand):
+    help = 'Move compiled code stored in DUCXContract rows to shared artifacts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500)
+
+    def handle(self, *args, **options):
+        migrated = 0
+        while True:
+            with transaction.atomic():
+                ducx_contracts = list(DUCXContract.objects.filter(artifact__isnull=True).defer(None).only(
+                    'id', 'legacy_source_code', 'legacy_bytecode', 'legacy_abi', 'compiler_version'
+                ).select_for_update()[:options['batch']])
+                if not ducx_contracts:
+                    break
+                for ducx_contract in ducx_contracts:
+                    artifact = get_artifact(
+                        ducx_contract.legacy_source_code, ducx_contract.legacy_bytecode,
+                        ducx_contract.legacy_abi, ducx_contract.compiler_version
+                    )
+                    DUCXContract.objects.filter(id=ducx_contract.id).update(
+                        artifact=artifact, legacy_source_code='', legacy_bytecode='', legacy_abi={}
+                    )
+            migrated += len(ducx_contracts)
+            self.stdout.write('migrated %d' % migrated)
+
+        cleared = Contract.objects.exclude(source_code='', bytecode='').update(
+            source_code='', bytecode='', abi={}, compiler_version=None
+        )
+        self.stdout.write('Successfully migrated %d contracts, cleared %d duplicate copies' % (migrated, cleared))
@@ -29,3 +29,10 @@ class CurrencyStatisticsCache(models.Model):
     usd_price_rub = models.FloatField(default=0, null=True)
     usd_percent_change_24h = models.FloatField(default=0, null=True)
     updated_at = models.DateTimeField(auto_now_add=True)
+
+
+class RatesCache(models.Model):
+    id = models.IntegerField(default=1, null=False, primary_key=True)
+    duc_usd_price = models.FloatField(null=True)
+    ducx_usd_price = models.FloatField(null=True)
+    updated_at = models.DateTimeField(null=True)
@@ -8,7 +8,8 @@ from ethereum.abi import method_id as m_id
 from eth_utils import int_to_big_endian
 
 from django.db import transaction
-from django.core.mail import send_mail, get_connection, EmailMessage
+from django.db.models import Count, Manager, Prefetch, prefetch_related_objects
+from ducx_wish.other.models import queue_mail
 from django.utils import timezone
 from rest_framework.exceptions import PermissionDenied
 from rest_framework import serializers
@@ -60,12 +61,56 @@ class TokenHolderSerializer(serializers.ModelSerializer):
         fields = ('address', 'amount', 'freeze_date', 'name')
 
 
+def ducx_contract_prefetch(lookup):
+    # rows not yet moved to an artifact need their own code columns, loading them
+    # here saves three lazy queries per contract; moved rows have them emptied
+    return Prefetch(lookup, queryset=DUCXContract.objects.defer(None).select_related('artifact'))
+
+
+CONTRACT_LIST_PREFETCH = (
+    'network',
+    'heir_set',
+    'tokenholder_set',
+    ducx_contract_prefetch('contractdetailslastwill_set__ducx_contract'),
+    'contractdetailslastwill_set__btc_key',
+    ducx_contract_prefetch('contractdetailsdelayedpayment_set__ducx_contract'),
+    ducx_contract_prefetch('contractdetailsico_set__ducx_contract_token'),
+    ducx_contract_prefetch('contractdetailsico_set__ducx_contract_crowdsale'),
+    ducx_contract_prefetch('contractdetailstoken_set__ducx_contract_token'),
+    'contractdetailstoken_set__ducx_contract_token__ico_details_token__contract',
+    ducx_contract_prefetch('contractdetailsairdrop_set__ducx_contract'),
+    ducx_contract_prefetch('contractdetailsinvestmentpool_set__ducx_contract'),
+)
+
+
+def count_airdrop_addresses(contract_ids):
+    counts = {contract_id: {} for contract_id in contract_ids}
+    for contract_id, state, count in AirdropAddress.objects.filter(
+            contract_id__in=contract_ids, active=True
+    ).values_list('contract_id', 'state').annotate(count=Count('id')).order_by():
+        counts[contract_id][state] = count
+    return counts
+
+
+class ContractListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        contracts = list(data.all() if isinstance(data, Manager) else data)
+        prefetch_related_objects(contracts, *CONTRACT_LIST_PREFETCH)
+        airdrops = [contract for contract in contracts if contract.contract_type == 8]
+        if airdrops:
+            counts = count_airdrop_addresses([contract.id for contract in airdrops])
+            for contract in airdrops:
+                contract.airdrop_counts = counts[contract.id]
+        return super().to_representation(contracts)
+
+
 class ContractSerializer(serializers.ModelSerializer):
     contract_details = serializers.JSONField(write_only=True)
     feedback_email = serializers.CharField(allow_blank=True)
 
     class Meta:
         model = Contract
+        list_serializer_class = ContractListSerializer
         fields = (
             'id', 'user', 'owner_address', 'state', 'created_date', 'balance',
             'cost', 'name', 'contract_type', 'contract_details', 'network', 'feedback_email'
@@ -123,7 +168,7 @@ class ContractSerializer(serializers.ModelSerializer):
 
             network_name = MAIL_NETWORK[network.name]
             if contract.contract_type not in (11, 20, 21, 23):
-                send_mail(
+                queue_mail(
                     email_messages.create_subject,
                     email_messages.create_message.format(
                         network_name=network_name
@@ -435,7 +480,7 @@ class ContractDetailsICOSerializer(serializers.ModelSerializer):
         res = super().to_representation(contract_details)
         token_holder_serializer = TokenHolderSerializer()
         res['token_holders'] = [token_holder_serializer.to_representation(th) for th in
-                                contract_details.contract.tokenholder_set.order_by('id').all()]
+                                sorted(contract_details.contract.tokenholder_set.all(), key=lambda th: th.id)]
         res['ducx_contract_token'] = DUCXContractSerializer().to_representation(contract_details.ducx_contract_token)
         res['ducx_contract_crowdsale'] = DUCXContractSerializer().to_representation(
             contract_details.ducx_contract_crowdsale)
@@ -519,12 +564,14 @@ class ContractDetailsTokenSerializer(serializers.ModelSerializer):
         res = super().to_representation(contract_details)
         token_holder_serializer = TokenHolderSerializer()
         res['token_holders'] = [token_holder_serializer.to_representation(th) for th in
-                                contract_details.contract.tokenholder_set.order_by('id').all()]
+                                sorted(contract_details.contract.tokenholder_set.all(), key=lambda th: th.id)]
         res['ducx_contract_token'] = DUCXContractSerializer().to_representation(contract_details.ducx_contract_token)
-        if contract_details.ducx_contract_token and contract_details.ducx_contract_token.ico_details_token.filter(
-                contract__state='ACTIVE'):
-            res['crowdsale'] = contract_details.ducx_contract_token.ico_details_token.filter(
-                contract__state__in=('ACTIVE', 'ENDED')).order_by('id')[0].contract.id
+        if contract_details.ducx_contract_token:
+            crowdsales = sorted(contract_details.ducx_contract_token.ico_details_token.all(), key=lambda d: d.id)
+            if any(ico.contract.state == 'ACTIVE' for ico in crowdsales):
+                res['crowdsale'] = [
+                    ico for ico in crowdsales if ico.contract.state in ('ACTIVE', 'ENDED')
+                ][0].contract.id
         if contract_details.contract.network.name in ['DUCATUSX_TESTNET', 'RSK_TESTNET']:
             res['ducx_contract_token']['source_code'] = ''
         return res
@@ -551,10 +598,12 @@ class ContractDetailsAirdropSerializer(serializers.ModelSerializer):
     def to_representation(self, contract_details):
         res = super().to_representation(contract_details)
         res['ducx_contract'] = DUCXContractSerializer().to_representation(contract_details.ducx_contract)
-        res['added_count'] = contract_details.contract.airdropaddress_set.filter(state='added', active=True).count()
-        res['processing_count'] = contract_details.contract.airdropaddress_set.filter(state='processing',
-                                                                                      active=True).count()
-        res['sent_count'] = contract_details.contract.airdropaddress_set.filter(state='sent', active=True).count()
+        counts = getattr(contract_details.contract, 'airdrop_counts', None)
+        if counts is None:
+            counts = count_airdrop_addresses([contract_details.contract.id])[contract_details.contract.id]
+        res['added_count'] = counts.get('added', 0)
+        res['processing_count'] = counts.get('processing', 0)
+        res['sent_count'] = counts.get('sent', 0)
         return res
 
     def create(self, contract, contract_details):
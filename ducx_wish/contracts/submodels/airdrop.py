@@ -1,3 +1,5 @@
+from collections import defaultdict, deque
+
 from django.db import models
 
 from ducx_wish.contracts.submodels.common import *
@@ -30,15 +32,10 @@ class ContractDetailsAirdrop(CommonDetails):
         ]
 
     def compile(self, _=''):
-        dest = path.join(CONTRACTS_DIR, 'ducx_wish/airdrop-contract/')
-        with open(path.join(dest, 'build/contracts/AirDrop.json'), 'rb') as f:
-            airdrop_json = json.loads(f.read().decode('utf-8-sig'))
-        with open(path.join(dest, 'contracts/AirDrop.sol'), 'rb') as f:
-            source_code = f.read().decode('utf-8-sig')
-        self.ducx_contract = create_ethcontract_in_compile(
-            airdrop_json['abi'], airdrop_json['bytecode'][2:],
-            airdrop_json['compiler']['version'], self.contract, source_code
+        artifact = load_template_artifact(
+            'ducx_wish/airdrop-contract/', 'contracts/AirDrop.sol', 'build/contracts/AirDrop.json'
         )
+        self.ducx_contract = create_ethcontract_from_artifact(artifact, self.contract)
         self.save()
 
     @blocking
@@ -74,31 +71,36 @@ class ContractDetailsAirdrop(CommonDetails):
             'REJECTED': 'processing'
         }[message['status']]
 
-        ids = []
-        for js in message['airdroppedAddresses']:
-            address = js['address']
-            amount = js['value']
-            addr = AirdropAddress.objects.filter(
-                address=address,
-                amount=amount,
+        states = [old_state]
+        if message['status'] == 'COMMITTED':
+            # in case 'pending' msg was lost or dropped, but 'commited' is there
+            states.append('added')
+
+        # (address, amount) -> state -> ids, matched as a multiset in one pass
+        candidates = defaultdict(lambda: {state: deque() for state in states})
+        for addr_id, address, amount, state in AirdropAddress.objects.filter(
                 contract=self.contract,
                 active=True,
-                state=old_state,
-            ).exclude(id__in=ids).first()
-            # in case 'pending' msg was lost or dropped, but 'commited' is there
-            if addr is None and message['status'] == 'COMMITTED':
-                old_state = 'added'
-                addr = AirdropAddress.objects.filter(
-                    address=address,
-                    amount=amount,
-                    contract=self.contract,
-                    active=True,
-                    state=old_state
-                ).exclude(id__in=ids).first()
-            if addr is None:
-                continue
+                state__in=states,
+                amount__isnull=False,
+                address__in={js['address'] for js in message['airdroppedAddresses']},
+        ).order_by('id').values_list('id', 'address', 'amount', 'state'):
+            candidates[(address, int(amount))][state].append(addr_id)
 
-            ids.append(addr.id)
+        ids = []
+        for js in message['airdroppedAddresses']:
+            try:
+                value = int(js['value'])
+            except (TypeError, ValueError):
+                print('airdropped value is not an integer, skipped', js, flush=True)
+                continue
+            matches = candidates.get((js['address'], value))
+            if matches is None:
+                continue
+            for state in states:
+                if matches[state]:
+                    ids.append(matches[state].popleft())
+                    break
 
         if len(message['airdroppedAddresses']) != len(ids):
             print('=' * 40, len(message['airdroppedAddresses']), len(ids),
@@ -1,27 +1,35 @@
 from os import path
 import os
 import uuid
+import shutil
+import hashlib
 import binascii
-import pika
 from copy import deepcopy
 from base58 import b58decode
 from ethereum import abi
 
 from web3 import Web3, HTTPProvider, IPCProvider
 
-from django.db import models
+from django.db import models, IntegrityError, transaction
 from django.apps import apps
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 
-from ducx_wish.settings import SIGNER, CONTRACTS_DIR, CONTRACTS_TEMP_DIR
+from ducx_wish.settings import SIGNER, CONTRACTS_DIR, CONTRACTS_TEMP_DIR, CONTRACTS_BUILD_CACHE_DIR
+from ducx_wish.settings import DEPLOY_STAGES, DEPLOY_BROADCAST_RETRIES
 from ducx_wish.parint import *
 from ducx_wish.consts import MAX_WEI_DIGITS, MAIL_NETWORK
 from ducx_wish.deploy.models import Network
+from ducx_wish.publisher import publish_contract_message
+from ducx_wish.deploy.helpers import reserved_nonce, get_deploy_address, get_deploy_key, forget_nonce
+from ducx_wish.deploy.helpers import deploy_stage_queue
 from ducx_wish.contracts.decorators import *
 from email_messages import *
 
+# eth_sendRawTransaction errors of a transaction the node already has (geth, parity)
+KNOWN_TRANSACTION_ERRORS = ('already known', 'known transaction', 'already imported')
+
 
 def address_to_scripthash(address):
 
@@ -128,15 +136,7 @@ def add_time_bonuses(details):
 
 
 def create_ethcontract_in_compile(abi, bytecode, cv, contract, source_code):
-    ducx_contract_token = DUCXContract()
-    ducx_contract_token.abi = abi
-    ducx_contract_token.bytecode = bytecode
-    ducx_contract_token.compiler_version = cv
-    ducx_contract_token.contract = contract
-    ducx_contract_token.original_contract = contract
-    ducx_contract_token.source_code = source_code
-    ducx_contract_token.save()
-    return ducx_contract_token
+    return create_ethcontract_from_artifact(get_artifact(source_code, bytecode, abi, cv), contract)
 
 
 def add_real_params(params, admin_address, address, wallet_address):
@@ -158,6 +158,87 @@ def create_directory(details, sour_path='ducx_wish/ico-crowdsale/*', config_name
     return dest, preproc_config
 
 
+@memoize_timeout(60)
+def hash_template_tree(sour_path):
+    root = path.join(CONTRACTS_DIR, sour_path.rstrip('*'))
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in ('node_modules', 'build', '.git'))
+        for filename in sorted(filenames):
+            file_path = path.join(dirpath, filename)
+            digest.update(path.relpath(file_path, root).encode())
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def build_cache_key(sour_path, params):
+    digest = hashlib.sha256(hash_template_tree(sour_path).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def load_build_cache(key, names):
+    cache_dir = path.join(CONTRACTS_BUILD_CACHE_DIR, key)
+    if not path.isdir(cache_dir):
+        return None
+    artifacts = {}
+    for name in names:
+        with open(path.join(cache_dir, name + '.json'), 'rb') as f:
+            artifact_json = json.loads(f.read().decode('utf-8-sig'))
+        with open(path.join(cache_dir, name + '.sol'), 'rb') as f:
+            source_code = f.read().decode('utf-8-sig')
+        artifacts[name] = artifact_json, source_code
+    return artifacts
+
+
+def save_build_cache(key, dest, names):
+    os.makedirs(CONTRACTS_BUILD_CACHE_DIR, exist_ok=True)
+    cache_dir = path.join(CONTRACTS_BUILD_CACHE_DIR, key)
+    temp_dir = '{}.{}'.format(cache_dir, uuid.uuid4())
+    os.mkdir(temp_dir)
+    for name in names:
+        shutil.copyfile(path.join(dest, 'build/contracts', name + '.json'), path.join(temp_dir, name + '.json'))
+        shutil.copyfile(path.join(dest, 'build', name + '.sol'), path.join(temp_dir, name + '.sol'))
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        # built concurrently by another worker
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def compile_with_cache(details, sour_path, config_name, test_func, test_params, params, compile_command, names):
+    '''
+    returns {name: (artifact json, flattened source)} for the template built with params,
+    compile and tests are skipped when the same sources and params were built before
+    '''
+    key = build_cache_key(sour_path, params)
+    artifacts = load_build_cache(key, names)
+    if artifacts is not None:
+        print('build cache hit', key, flush=True)
+        details.temp_directory = str(uuid.uuid4())
+        return artifacts
+    dest, preproc_config = create_directory(details, sour_path, config_name)
+    tested_marker = path.join(CONTRACTS_BUILD_CACHE_DIR, build_cache_key(sour_path, test_params) + '.tested')
+    tested_now = False
+    if path.exists(tested_marker):
+        print('tests already passed for these params', flush=True)
+    else:
+        test_func(preproc_config, test_params, dest)
+        tested_now = True
+        os.makedirs(CONTRACTS_BUILD_CACHE_DIR, exist_ok=True)
+        open(tested_marker, 'w').close()
+    with open(preproc_config, 'w') as f:
+        f.write(json.dumps(params))
+    # tests compile the template too, no need to build the same params twice
+    already_built = tested_now and test_params == params
+    if not already_built and os.system("/bin/bash -c 'cd {dest} && {command}'".format(
+            dest=dest, command=compile_command)):
+        raise Exception('compiler error while deploying')
+    save_build_cache(key, dest, names)
+    return load_build_cache(key, names)
+
+
 def test_investment_pool_params(config, params, dest):
     with open(config, 'w') as f:
         f.write(json.dumps(params))
@@ -204,22 +285,8 @@ def test_neo_ico_params(config, params, dest):
 
 
 def send_in_queue(contract_id, type, queue):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        'localhost',
-        5672,
-        'ducxwill',
-        pika.PlainCredentials('ducxwill', 'ducxwill'),
-    ))
-    channel = connection.channel()
-    channel.queue_declare(queue=queue, durable=True, auto_delete=False,
-                          exclusive=False)
-    channel.basic_publish(
-        exchange='',
-        routing_key=queue,
-        body=json.dumps({'status': 'COMMITTED', 'contractId': contract_id}),
-        properties=pika.BasicProperties(type=type),
-    )
-    connection.close()
+    # inside a handler transaction the consumer must not see the message before the changes
+    transaction.on_commit(lambda: publish_contract_message(queue, contract_id, type))
 
 
 def sign_transaction(address, nonce, gaslimit, network, value=None, dest=None, contract_data=None, gas_price=None):
@@ -245,6 +312,21 @@ def sign_transaction(address, nonce, gaslimit, network, value=None, dest=None, c
 
 
 
+class DeferredFieldsManager(models.Manager):
+    '''
+    leaves heavy columns out of the select, they are loaded on first access
+    '''
+    def __init__(self, *deferred):
+        super().__init__()
+        self.deferred = deferred
+
+    def deconstruct(self):
+        return (False, '%s.%s' % (self.__module__, self.__class__.__name__), None, self.deferred, {})
+
+    def get_queryset(self):
+        return super().get_queryset().defer(*self.deferred)
+
+
 '''
 contract as user see it at site. contract as service. can contain more then one real ethereum contracts
 '''
@@ -257,6 +339,8 @@ class Contract(models.Model):
     address = models.CharField(max_length=50, null=True, default=None)
     owner_address = models.CharField(max_length=50, null=True, default=None)
     user_address = models.CharField(max_length=50, null=True, default=None)
+    # platform address the contract was deployed from and is administrated by
+    deploy_address = models.CharField(max_length=50, null=True, default=None)
 
     balance = models.DecimalField(
         max_digits=MAX_WEI_DIGITS, decimal_places=0, null=True, default=None
@@ -267,8 +351,9 @@ class Contract(models.Model):
     state = models.CharField(max_length=63, default='CREATED')
     contract_type = models.IntegerField(default=0)
 
-    source_code = models.TextField()
-    bytecode = models.TextField()
+    # unused, the compiled code lives in ContractArtifact
+    source_code = models.TextField(default='')
+    bytecode = models.TextField(default='')
     abi = JSONField(default={})
     compiler_version = models.CharField(
         max_length=200, null=True, default=None
@@ -284,22 +369,33 @@ class Contract(models.Model):
 
     feedback_email = models.CharField(max_length=200, null=True, default=None)
 
+    objects = DeferredFieldsManager('source_code', 'bytecode', 'abi', 'compiler_version')
+
+    class Meta:
+        base_manager_name = 'objects'
+
     def save(self, *args, **kwargs):
         # disable balance saving to prevent collisions with java daemon
         print(args)
         str_args = ','.join([str(x) for x in args])
         if self.id:
+            # deferred columns were not loaded, so they have nothing to update
+            deferred = self.get_deferred_fields()
             kwargs['update_fields'] = list(
-                    {f.name for f in Contract._meta.fields if f.name not in ('balance', 'id')}
+                    {f.name for f in Contract._meta.fields if f.name not in ('balance', 'id') and f.attname not in deferred}
                     &
                     set(kwargs.get('update_fields', [f.name for f in Contract._meta.fields]))
             )
         return super().save(*args, **kwargs)
 
     def get_details(self):
-        return getattr(self, self.get_details_model(
+        details_set = getattr(self, self.get_details_model(
             self.contract_type
-        ).__name__.lower()+'_set').first()
+        ).__name__.lower()+'_set')
+        # use details loaded by prefetch_related (see ContractListSerializer)
+        if details_set.field.related_query_name() in getattr(self, '_prefetched_objects_cache', {}):
+            return min(details_set.all(), key=lambda details: details.id, default=None)
+        return details_set.first()
 
     @classmethod
     def get_all_details_model(cls):
@@ -338,6 +434,69 @@ real contract to deploy to ethereum
 '''
 
 
+class ContractArtifact(models.Model):
+    '''
+    compiler output shared by every DUCXContract built from the same source
+    '''
+    hash = models.CharField(max_length=64, unique=True)
+    source_code = models.TextField()
+    bytecode = models.TextField()
+    abi = JSONField(default={})
+    compiler_version = models.CharField(
+        max_length=200, null=True, default=None
+    )
+
+
+def get_artifact(source_code, bytecode, abi, compiler_version):
+    artifact_hash = hashlib.sha256(json.dumps(
+        [source_code, bytecode, abi, compiler_version], sort_keys=True
+    ).encode()).hexdigest()
+    try:
+        artifact, _ = ContractArtifact.objects.get_or_create(hash=artifact_hash, defaults={
+            'source_code': source_code, 'bytecode': bytecode,
+            'abi': abi, 'compiler_version': compiler_version
+        })
+    except IntegrityError:
+        # stored concurrently by another worker
+        artifact = ContractArtifact.objects.get(hash=artifact_hash)
+    return artifact
+
+
+# (source path, result path) -> (modification times, artifact)
+template_artifacts = {}
+
+
+def load_template_artifact(sol_path, source_filename, result_filename):
+    '''
+    artifact of a template which is not parameterized, files are read once
+    per process and again only after they change
+    '''
+    source_path = path.join(CONTRACTS_DIR, sol_path, source_filename)
+    result_path = path.join(CONTRACTS_DIR, sol_path, result_filename)
+    mtimes = (os.stat(source_path).st_mtime, os.stat(result_path).st_mtime)
+    cached = template_artifacts.get((source_path, result_path))
+    if cached is not None and cached[0] == mtimes:
+        return cached[1]
+    with open(source_path, 'rb') as f:
+        source = f.read().decode('utf-8-sig')
+    with open(result_path, 'rb') as f:
+        result = json.loads(f.read().decode('utf-8-sig'))
+    artifact = get_artifact(source, result['bytecode'][2:], result['abi'], result['compiler']['version'])
+    template_artifacts[(source_path, result_path)] = mtimes, artifact
+    return artifact
+
+
+def create_ethcontract_from_artifact(artifact, contract):
+    ducx_contract = DUCXContract(
+        artifact=artifact,
+        compiler_version=artifact.compiler_version,
+        contract=contract,
+        original_contract=contract
+    )
+    ducx_contract.save()
+    return ducx_contract
+
+
 class DUCXContract(models.Model):
     contract = models.ForeignKey(Contract, null=True, default=None)
     original_contract = models.ForeignKey(
@@ -346,48 +505,129 @@ class DUCXContract(models.Model):
     address = models.CharField(max_length=50, null=True, default=None)
     tx_hash = models.CharField(max_length=70, null=True, default=None)
 
-    source_code = models.TextField()
-    bytecode = models.TextField()
-    abi = JSONField(default={})
+    artifact = models.ForeignKey(ContractArtifact, null=True, default=None)
+    # own copies of the compiler output, only for contracts without an artifact
+    legacy_source_code = models.TextField(db_column='source_code', default='')
+    legacy_bytecode = models.TextField(db_column='bytecode', default='')
+    legacy_abi = JSONField(db_column='abi', default={})
     compiler_version = models.CharField(
         max_length=200, null=True, default=None
     )
     constructor_arguments = models.TextField()
+    # signed deploy transaction waiting for the broadcast stage
+    signed_tx = models.TextField(null=True, default=None)
+
+    objects = DeferredFieldsManager('legacy_source_code', 'legacy_bytecode', 'legacy_abi')
+
+    class Meta:
+        base_manager_name = 'objects'
+
+    @property
+    def source_code(self):
+        return self.artifact.source_code if self.artifact_id else self.legacy_source_code
+
+    @property
+    def bytecode(self):
+        return self.artifact.bytecode if self.artifact_id else self.legacy_bytecode
+
+    @property
+    def abi(self):
+        return self.artifact.abi if self.artifact_id else self.legacy_abi
+
+
+class DeployTask(models.Model):
+    '''
+    progress of a contract through the deploy pipeline:
+    compile -> sign -> broadcast -> sent
+    '''
+    contract = models.OneToOneField(Contract)
+    stage = models.CharField(max_length=10, db_index=True)
+    ducx_contract_attr = models.CharField(max_length=50, null=True, default=None)
+    attempts = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ProcessedMessage(models.Model):
+    '''
+    blockchain event already handled by the receiver, written in the handler transaction
+    '''
+    network = models.CharField(max_length=50)
+    type = models.CharField(max_length=50)
+    tx_hash = models.CharField(max_length=70, db_index=True)
+    # sha256 of the whole message, events of one transaction differ in contract, status etc.
+    digest = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('network', 'type', 'digest')
+
+
+def record_processed_message(network, type, message):
+    '''
+    None if the message was already processed, must be called inside a transaction
+    '''
+    digest = hashlib.sha256(json.dumps(message, sort_keys=True).encode()).hexdigest()
+    try:
+        with transaction.atomic():
+            return ProcessedMessage.objects.create(
+                network=network, type=type, tx_hash=message['transactionHash'], digest=digest
+            )
+    except IntegrityError:
+        return None
+
+
+def send_to_deploy_stage(contract, stage, ducx_contract_attr=None):
+    DeployTask.objects.update_or_create(contract=contract, defaults={
+        'stage': stage, 'ducx_contract_attr': ducx_contract_attr, 'attempts': 0
+    })
+    queue_name = deploy_stage_queue(contract.network.name, stage)
+    transaction.on_commit(lambda: publish_contract_message(queue_name, contract.id, stage + '_stage'))
+
+
+def resume_deploy_stages(network_name):
+    # stages interrupted by a restart, duplicates are ignored by stage check
+    for task in DeployTask.objects.filter(
+            contract__network__name=network_name, stage__in=DEPLOY_STAGES
+    ).select_related('contract'):
+        publish_contract_message(deploy_stage_queue(network_name, task.stage), task.contract.id, task.stage + '_stage')
 
 
 class CommonDetails(models.Model):
     class Meta:
         abstract = True
     contract = models.ForeignKey(Contract)
+    # templates with the deploy address built in are compiled by deploy(),
+    # after the sign stage has locked and stored the address
+    compile_in_sign_stage = False
 
     def compile(self, ducx_contract_attr_name='ducx_contract'):
         print('compiling', flush=True)
-        sol_path = self.sol_path
         if getattr(self, ducx_contract_attr_name):
             getattr(self, ducx_contract_attr_name).delete()
-        sol_path = path.join(CONTRACTS_DIR, sol_path)
-        with open(path.join(sol_path, self.source_filename), 'rb') as f:
-            source = f.read().decode('utf-8-sig')
-        result_name = path.join(sol_path, self.result_filename)
-        with open(result_name, 'rb') as f:
-            result =json.loads(f.read().decode('utf-8-sig'))
-        ducx_contract = DUCXContract()
-        ducx_contract.source_code = source
-        ducx_contract.compiler_version = result['compiler']['version']
-        ducx_contract.abi = result['abi']
-        ducx_contract.bytecode = result['bytecode'][2:]
-        ducx_contract.contract = self.contract
-        ducx_contract.original_contract = self.contract
-        ducx_contract.save()
-        setattr(self, ducx_contract_attr_name, ducx_contract)
+        artifact = load_template_artifact(self.sol_path, self.source_filename, self.result_filename)
+        setattr(self, ducx_contract_attr_name, create_ethcontract_from_artifact(artifact, self.contract))
         self.save()
 
+    def start_deploy(self):
+        if self.contract.state not in ('CREATED', 'WAITING_FOR_DEPLOYMENT'):
+            print('launch message ignored because already deployed', flush=True)
+            return
+        send_to_deploy_stage(self.contract, 'compile')
+
+    @postponable
+    def compile_stage(self):
+        # runs before the deploy address is locked
+        if not self.compile_in_sign_stage:
+            self.compile()
+        send_to_deploy_stage(self.contract, 'sign')
+
     def deploy(self, ducx_contract_attr_name='ducx_contract'):
         if self.contract.state not in ('CREATED', 'WAITING_FOR_DEPLOYMENT'):
             print('launch message ignored because already deployed', flush=True)
-            take_off_blocking(self.contract.network.name)
+            take_off_blocking(self.contract.network.name, self.contract.id)
             return
-        self.compile(ducx_contract_attr_name)
+        if getattr(self, ducx_contract_attr_name) is None:
+            self.compile(ducx_contract_attr_name)
         ducx_contract = getattr(self, ducx_contract_attr_name)
         tr = abi.ContractTranslator(ducx_contract.abi)
         arguments = self.get_arguments(ducx_contract_attr_name)
@@ -396,66 +636,95 @@ class CommonDetails(models.Model):
             tr.encode_constructor_arguments(arguments)
         ).decode() if arguments else ''
         eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-        address = NETWORKS[self.contract.network.name]['address']
-        nonce = int(eth_int.eth_getTransactionCount(address, "pending"), 16)
-        print('nonce', nonce, flush=True)
-        # print('BYTECODE', ducx_contract.bytecode, flush=True)
-        # print('CONTRACT CODE', ducx_contract.bytecode + binascii.hexlify(tr.encode_constructor_arguments(arguments)).decode() if arguments else '', flush=True)
-        data = ducx_contract.bytecode + (binascii.hexlify(
-            tr.encode_constructor_arguments(arguments)
-        ).decode() if arguments else '')
-        print('data =', data)
-        # if arguments:
-        #     data = ducx_contract.bytecode + (binascii.hexlify(
-        #         tr.encode_constructor_arguments(arguments)
-        #     ).decode())
-        # else:
-        #     data = ducx_contract.bytecode
-
+        address = get_deploy_address(self.contract)
+        chain_id = eth_int.chain_id()
+        data = ducx_contract.bytecode + ducx_contract.constructor_arguments
         print('DATA', data, flush=True)
 
         gas_price = 41 * 10 ** 9
-        sign_key = NETWORKS[self.contract.network.name]['private_key']
-        chain_id = eth_int.eth_chainId()
-
-        tx_params = {
-            'value': self.get_value(),
-            'gas': self.get_gaslimit(),
-            'gasPrice':gas_price,
-            'nonce': nonce,
-            'chainId': chain_id,
-            'data': data
-        }
-
-        w3 = Web3(HTTPProvider(eth_int.url))
-        signed_tx = w3.eth.account.signTransaction(tx_params, sign_key)
-        signed_tx_raw = signed_tx.rawTransaction.hex()
-
-        print('fields of transaction', flush=True)
-        print('source', address, flush=True)
-        print('gas limit', self.get_gaslimit(), flush=True)
-        print('value', self.get_value(), flush=True)
-        print('network', self.contract.network.name, flush=True)
-        print('signed_data', signed_tx, flush=True)
-        print('signed_data raw', signed_tx_raw, flush=True)
-        ducx_contract.tx_hash = eth_int.eth_sendRawTransaction(signed_tx_raw)
-        ducx_contract.save()
-        print('transaction sent', flush=True)
+        sign_key = get_deploy_key(self.contract)
+
+        with reserved_nonce(eth_int, self.contract.network.name, address) as nonce:
+            print('nonce', nonce, flush=True)
+            tx_params = {
+                'value': self.get_value(),
+                'gas': self.get_gaslimit(),
+                'gasPrice':gas_price,
+                'nonce': nonce,
+                'chainId': chain_id,
+                'data': data
+            }
+
+            w3 = Web3(HTTPProvider(eth_int.url))
+            signed_tx = w3.eth.account.signTransaction(tx_params, sign_key)
+            signed_tx_raw = signed_tx.rawTransaction.hex()
+
+            print('fields of transaction', flush=True)
+            print('source', address, flush=True)
+            print('gas limit', self.get_gaslimit(), flush=True)
+            print('value', self.get_value(), flush=True)
+            print('network', self.contract.network.name, flush=True)
+            print('signed_data', signed_tx, flush=True)
+            print('signed_data raw', signed_tx_raw, flush=True)
+            ducx_contract.signed_tx = signed_tx_raw
+            ducx_contract.tx_hash = signed_tx.hash.hex()
+            ducx_contract.save()
+        print('transaction signed', flush=True)
         self.contract.state = 'WAITING_FOR_DEPLOYMENT'
         self.contract.save()
+        send_to_deploy_stage(self.contract, 'broadcast', ducx_contract_attr_name)
+
+    def broadcast(self, task):
+        ducx_contract = getattr(self, task.ducx_contract_attr)
+        if not ducx_contract.signed_tx:
+            return
+        eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
+        try:
+            eth_int.eth_sendRawTransaction(ducx_contract.signed_tx)
+        except Exception as e:
+            error = str(e).lower()
+            if not any(known in error for known in KNOWN_TRANSACTION_ERRORS):
+                print('broadcast failed', self.contract.id, e, flush=True)
+                if 'nonce' not in error and task.attempts + 1 < DEPLOY_BROADCAST_RETRIES:
+                    task.attempts += 1
+                    task.save(update_fields=['attempts', 'updated_at'])
+                    raise NeedRequeue()
+                # 'nonce too low' also comes when this very transaction was
+                # sent before a restart and is already mined
+                if ducx_contract.tx_hash and eth_int.eth_getTransactionByHash(ducx_contract.tx_hash):
+                    print('transaction found on node', ducx_contract.tx_hash, flush=True)
+                    self._broadcast_done(task, ducx_contract)
+                    return
+                # the nonce reserved at sign time will never be used, later
+                # transactions of the address would wait behind the gap
+                forget_nonce(self.contract.network.name, get_deploy_address(self.contract))
+                task.stage = 'failed'
+                task.save(update_fields=['stage', 'updated_at'])
+                self.tx_failed({})
+                return
+            # sent before a restart, the node already has it
+        self._broadcast_done(task, ducx_contract)
+
+    @staticmethod
+    def _broadcast_done(task, ducx_contract):
+        ducx_contract.signed_tx = None
+        ducx_contract.save(update_fields=['signed_tx'])
+        task.stage = 'sent'
+        task.save(update_fields=['stage', 'updated_at'])
+        print('transaction sent', ducx_contract.tx_hash, flush=True)
 
     def msg_deployed(self, message, ducx_contract_attr_name='ducx_contract'):
         network_link = NETWORKS[self.contract.network.name]['link_address']
         network = self.contract.network.name
         network_name = MAIL_NETWORK[network]
-        take_off_blocking(self.contract.network.name)
+        take_off_blocking(self.contract.network.name, self.contract.id)
         ducx_contract = getattr(self, ducx_contract_attr_name)
         ducx_contract.address = message['address']
         ducx_contract.save()
         self.contract.state = 'ACTIVE'
         self.contract.save()
         if self.contract.user.email:
-            send_mail(
+            queue_mail(
                     common_subject,
                     common_text.format(
                         contract_type_name=self.contract.get_all_details_model()[self.contract.contract_type]['name'],
@@ -472,7 +741,7 @@ class CommonDetails(models.Model):
     def tx_failed(self, message):
         self.contract.state = 'POSTPONED'
         self.contract.save()
-        send_mail(
+        queue_mail(
             postponed_subject,
             postponed_message.format(
                 contract_id=self.contract.id
@@ -487,23 +756,22 @@ class CommonDetails(models.Model):
     def predeploy_validate(self):
         pass
 
-    @blocking
     def check_contract(self):
         print('checking', self.contract.name)
         tr = abi.ContractTranslator(self.ducx_contract.abi)
         eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-        address = self.contract.network.deployaddress_set.all()[0].address
-        nonce = int(eth_int.eth_getTransactionCount(address, "pending"), 16)
-        print('nonce', nonce)
-        signed_data = sign_transaction(
-            address, nonce, 600000, self.contract.network.name,
-            dest=self.ducx_contract.address,
-            contract_data=binascii.hexlify(
-                tr.encode_function_call('check', [])
-            ).decode(),
-        )
-        print('signed_data', signed_data)
-        eth_int.eth_sendRawTransaction('0x' + signed_data)
+        address = get_deploy_address(self.contract)
+        with reserved_nonce(eth_int, self.contract.network.name, address) as nonce:
+            print('nonce', nonce)
+            signed_data = sign_transaction(
+                address, nonce, 600000, self.contract.network.name,
+                dest=self.ducx_contract.address,
+                contract_data=binascii.hexlify(
+                    tr.encode_function_call('check', [])
+                ).decode(),
+            )
+            print('signed_data', signed_data)
+            eth_int.eth_sendRawTransaction('0x' + signed_data)
         print('check ok!')
 
 
@@ -1,5 +1,5 @@
 from django.db import models
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
@@ -50,7 +50,7 @@ class ContractDetailsDelayedPayment(CommonDetails):
     def triggered(self, message):
         link = NETWORKS[self.ducx_contract.contract.network.name]['link_tx']
         if self.recepient_email:
-            send_mail(
+            queue_mail(
                 heir_subject,
                 heir_message.format(
                     user_address=self.recepient_address,
@@ -62,7 +62,7 @@ class ContractDetailsDelayedPayment(CommonDetails):
         self.contract.state = 'TRIGGERED'
         self.contract.save()
         if self.contract.user.email:
-            send_mail(
+            queue_mail(
                 carry_out_subject,
                 carry_out_message,
                 DEFAULT_FROM_EMAIL,
@@ -4,7 +4,7 @@ from ethereum import abi
 from ethereum.utils import checksum_encode
 
 from django.db import models
-from django.core.mail import send_mail, EmailMessage
+from ducx_wish.other.models import queue_mail
 from django.contrib.postgres.fields import JSONField
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
@@ -18,6 +18,8 @@ from email_messages import *
 @contract_details('MyWish ICO')
 class ContractDetailsICO(CommonDetails):
     sol_path = 'ducx_wish/contracts/contracts/ICO.sol'
+    # D_MYWISH_ADDRESS is the address the contract is deployed from
+    compile_in_sign_stage = True
 
     soft_cap = models.DecimalField(
         max_digits=MAX_WEI_DIGITS, decimal_places=0, null=True
@@ -96,7 +98,6 @@ class ContractDetailsICO(CommonDetails):
         if self.temp_directory:
             print('already compiled')
             return
-        dest, preproc_config = create_directory(self)
         token_holders = self.contract.tokenholder_set.all()
         amount_bonuses = add_amount_bonuses(self)
         time_bonuses = add_time_bonuses(self)
@@ -116,34 +117,24 @@ class ContractDetailsICO(CommonDetails):
             preproc_params["constants"]["D_MAX_VALUE_WEI"] = str(
                 int(self.max_wei))
 
-        test_crowdsale_params(preproc_config, preproc_params, dest)
-        address = NETWORKS[self.contract.network.name]['address']
+        test_params = deepcopy(preproc_params)
+        address = get_deploy_address(self.contract)
         preproc_params = add_real_params(
             preproc_params, self.admin_address,
             address, self.cold_wallet_address
         )
-        with open(preproc_config, 'w') as f:
-            f.write(json.dumps(preproc_params))
-        if os.system(
-                "/bin/bash -c 'cd {dest} && yarn compile-crowdsale'".format(
-                    dest=dest)
-        ):
-            raise Exception('compiler error while deploying')
-        with open(path.join(dest, 'build/contracts/TemplateCrowdsale.json'),
-                  'rb') as f:
-            crowdsale_json = json.loads(f.read().decode('utf-8-sig'))
-        with open(path.join(dest, 'build/TemplateCrowdsale.sol'), 'rb') as f:
-            source_code = f.read().decode('utf-8-sig')
+        artifacts = compile_with_cache(
+            self, 'ducx_wish/ico-crowdsale/*', 'c-preprocessor-config.json',
+            test_crowdsale_params, test_params, preproc_params,
+            'yarn compile-crowdsale', ['TemplateCrowdsale', 'MainToken']
+        )
+        crowdsale_json, source_code = artifacts['TemplateCrowdsale']
         self.ducx_contract_crowdsale = create_ethcontract_in_compile(
             crowdsale_json['abi'], crowdsale_json['bytecode'][2:],
             crowdsale_json['compiler']['version'], self.contract, source_code
         )
         if not self.reused_token:
-            with open(path.join(dest, 'build/contracts/MainToken.json'),
-                      'rb') as f:
-                token_json = json.loads(f.read().decode('utf-8-sig'))
-            with open(path.join(dest, 'build/MainToken.sol'), 'rb') as f:
-                source_code = f.read().decode('utf-8-sig')
+            token_json, source_code = artifacts['MainToken']
             self.ducx_contract_token = create_ethcontract_in_compile(
                 token_json['abi'], token_json['bytecode'][2:],
                 token_json['compiler']['version'], self.contract, source_code
@@ -155,16 +146,16 @@ class ContractDetailsICO(CommonDetails):
     @check_transaction
     def msg_deployed(self, message):
         print('msg_deployed method of the ico contract')
-        address = NETWORKS[self.contract.network.name]['address']
+        address = get_deploy_address(self.contract)
         if self.contract.state != 'WAITING_FOR_DEPLOYMENT':
-            take_off_blocking(self.contract.network.name)
+            take_off_blocking(self.contract.network.name, self.contract.id)
             return
         if self.reused_token:
             self.contract.state = 'WAITING_ACTIVATION'
             self.contract.save()
             self.ducx_contract_crowdsale.address = message['address']
             self.ducx_contract_crowdsale.save()
-            take_off_blocking(self.contract.network.name)
+            take_off_blocking(self.contract.network.name, self.contract.id)
             print('status changed to waiting activation')
             return
         if self.ducx_contract_token.id == message['contractId']:
@@ -176,28 +167,27 @@ class ContractDetailsICO(CommonDetails):
             self.ducx_contract_crowdsale.save()
             tr = abi.ContractTranslator(self.ducx_contract_token.abi)
             eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-            nonce = int(eth_int.eth_getTransactionCount(address, "pending"), 16)
-            print('nonce', nonce)
-            print('transferOwnership message signed')
-
-            sign_key = NETWORKS[self.contract.network.name]['private_key']
-            chain_id = eth_int.eth_chainId()
+            chain_id = eth_int.chain_id()
+            sign_key = get_deploy_key(self.contract)
 
             w3 = Web3(HTTPProvider(eth_int.url))
             contract = w3.eth.contract(address=checksum_encode(self.ducx_contract_token.address), abi=self.ducx_contract_token.abi)
-            tx = contract.functions.transferOwnership(checksum_encode(self.ducx_contract_crowdsale.address)).buildTransaction(
-                {'from': checksum_encode(NETWORKS[self.contract.network.name]['address']),
-                 'gas': self.get_gaslimit(),
-                 'chainId': chain_id,
-                 'nonce': nonce,
-                 'gasPrice': 100000,
-                 }
-            )
-
-            signed_tx = w3.eth.account.signTransaction(tx, sign_key)
-            signed_tx_raw = signed_tx.rawTransaction.hex()
-
-            self.ducx_contract_token.tx_hash = eth_int.eth_sendRawTransaction(signed_tx_raw)
+            with reserved_nonce(eth_int, self.contract.network.name, address) as nonce:
+                print('nonce', nonce)
+                tx = contract.functions.transferOwnership(checksum_encode(self.ducx_contract_crowdsale.address)).buildTransaction(
+                    {'from': checksum_encode(get_deploy_address(self.contract)),
+                     'gas': self.get_gaslimit(),
+                     'chainId': chain_id,
+                     'nonce': nonce,
+                     'gasPrice': 100000,
+                     }
+                )
+
+                signed_tx = w3.eth.account.signTransaction(tx, sign_key)
+                signed_tx_raw = signed_tx.rawTransaction.hex()
+                print('transferOwnership message signed')
+
+                self.ducx_contract_token.tx_hash = eth_int.eth_sendRawTransaction(signed_tx_raw)
             self.ducx_contract_token.save()
             print('transferOwnership message sended')
 
@@ -222,14 +212,14 @@ class ContractDetailsICO(CommonDetails):
     @postponable
     #    @check_transaction
     def ownershipTransferred(self, message):
-        address = NETWORKS[self.contract.network.name]['address']
+        address = get_deploy_address(self.contract)
         if message['contractId'] != self.ducx_contract_token.id:
             if self.contract.state == 'WAITING_FOR_DEPLOYMENT':
-                take_off_blocking(self.contract.network.name)
+                take_off_blocking(self.contract.network.name, self.contract.id)
             print('ignored', flush=True)
             return
         if self.contract.state in ('ACTIVE', 'ENDED'):
-            take_off_blocking(self.contract.network.name)
+            take_off_blocking(self.contract.network.name, self.contract.id)
             return
         if self.contract.state == 'WAITING_ACTIVATION':
             self.contract.state = 'WAITING_FOR_DEPLOYMENT'
@@ -237,34 +227,33 @@ class ContractDetailsICO(CommonDetails):
             # continue deploy: call init
         tr = abi.ContractTranslator(self.ducx_contract_crowdsale.abi)
         eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-        nonce = int(eth_int.eth_getTransactionCount(address, "pending"), 16)
+        chain_id = eth_int.chain_id()
         gas_limit = 100000 + 80000 * self.contract.tokenholder_set.all().count()
-        print('nonce', nonce)
 
-
-        sign_key = NETWORKS[self.contract.network.name]['private_key']
-        chain_id = eth_int.eth_chainId()
+        sign_key = get_deploy_key(self.contract)
 
         w3 = Web3(HTTPProvider(eth_int.url))
         contract = w3.eth.contract(address=checksum_encode(self.ducx_contract_crowdsale.address),
                                    abi=self.ducx_contract_crowdsale.abi)
-        print('building tx', flush=True)
-        tx = contract.functions.init().buildTransaction(
-            {'from': checksum_encode(NETWORKS[self.contract.network.name]['address']),
-             'gas': gas_limit,
-             'chainId': chain_id,
-             'nonce': nonce,
-             'gasPrice': 100000,
-             }
-        )
-        print('tx', tx, flush=True)
-        print('init message signing', flush=True)
+        with reserved_nonce(eth_int, self.contract.network.name, address) as nonce:
+            print('nonce', nonce)
+            print('building tx', flush=True)
+            tx = contract.functions.init().buildTransaction(
+                {'from': checksum_encode(get_deploy_address(self.contract)),
+                 'gas': gas_limit,
+                 'chainId': chain_id,
+                 'nonce': nonce,
+                 'gasPrice': 100000,
+                 }
+            )
+            print('tx', tx, flush=True)
+            print('init message signing', flush=True)
 
-        signed_tx = w3.eth.account.signTransaction(tx, sign_key)
-        signed_tx_raw = signed_tx.rawTransaction.hex()
-        print('signed tx raw', signed_tx_raw, flush=True)
+            signed_tx = w3.eth.account.signTransaction(tx, sign_key)
+            signed_tx_raw = signed_tx.rawTransaction.hex()
+            print('signed tx raw', signed_tx_raw, flush=True)
 
-        self.ducx_contract_crowdsale.tx_hash = eth_int.eth_sendRawTransaction(signed_tx_raw)
+            self.ducx_contract_crowdsale.tx_hash = eth_int.eth_sendRawTransaction(signed_tx_raw)
         self.ducx_contract_crowdsale.save()
         print('init message sended', flush=True)
 
@@ -274,7 +263,7 @@ class ContractDetailsICO(CommonDetails):
     def initialized(self, message):
         if self.contract.state != 'WAITING_FOR_DEPLOYMENT':
             return
-        take_off_blocking(self.contract.network.name)
+        take_off_blocking(self.contract.network.name, self.contract.id)
         if message['contractId'] != self.ducx_contract_crowdsale.id:
             print('ignored', flush=True)
             return
@@ -286,7 +275,7 @@ class ContractDetailsICO(CommonDetails):
         network_link = NETWORKS[self.contract.network.name]['link_address']
         network_name = MAIL_NETWORK[self.contract.network.name]
         if self.contract.user.email:
-            send_mail(
+            queue_mail(
                 ico_subject,
                 ico_text.format(
                     link1=network_link.format(
@@ -373,24 +362,20 @@ class ContractDetailsToken(CommonDetails):
         if self.temp_directory:
             print('already compiled')
             return
-        dest, preproc_config = create_directory(self)
         token_holders = self.contract.tokenholder_set.all()
         preproc_params = {"constants": {"D_ONLY_TOKEN": True}}
         preproc_params['constants'] = add_token_params(
             preproc_params['constants'], self, token_holders,
             False, self.future_minting
         )
-        test_token_params(preproc_config, preproc_params, dest)
+        test_params = deepcopy(preproc_params)
         preproc_params['constants']['D_CONTRACTS_OWNER'] = self.admin_address
-        with open(preproc_config, 'w') as f:
-            f.write(json.dumps(preproc_params))
-        if os.system('cd {dest} && yarn compile-token'.format(dest=dest)):
-            raise Exception('compiler error while deploying')
-
-        with open(path.join(dest, 'build/contracts/MainToken.json'), 'rb') as f:
-            token_json = json.loads(f.read().decode('utf-8-sig'))
-        with open(path.join(dest, 'build/MainToken.sol'), 'rb') as f:
-            source_code = f.read().decode('utf-8-sig')
+        artifacts = compile_with_cache(
+            self, 'ducx_wish/ico-crowdsale/*', 'c-preprocessor-config.json',
+            test_token_params, test_params, preproc_params,
+            'yarn compile-token', ['MainToken']
+        )
+        token_json, source_code = artifacts['MainToken']
         self.ducx_contract_token = create_ethcontract_in_compile(
             token_json['abi'], token_json['bytecode'][2:],
             token_json['compiler']['version'], self.contract, source_code
@@ -423,9 +408,9 @@ class ContractDetailsToken(CommonDetails):
                 mint_info = mint_info + str(th.amount) + '\n'
                 if th.freeze_date:
                     mint_info = mint_info + str(datetime.datetime.utcfromtimestamp(th.freeze_date).strftime('%Y-%m-%d %H:%M:%S')) + '\n'
-            mail = EmailMessage(
-                subject=authio_subject,
-                body=authio_message.format(
+            queue_mail(
+                authio_subject,
+                authio_message.format(
                     address=self.ducx_contract_token.address,
                     email=self.authio_email,
                     token_name=self.token_name,
@@ -435,11 +420,10 @@ class ContractDetailsToken(CommonDetails):
                     mint_info=mint_info if mint_info else 'No',
                     admin_address=self.admin_address
                 ),
-                from_email=DEFAULT_FROM_EMAIL,
-                to=[AUTHIO_EMAIL, SUPPORT_EMAIL]
+                DEFAULT_FROM_EMAIL,
+                [AUTHIO_EMAIL, SUPPORT_EMAIL]
             )
-            mail.send()
-            send_mail(
+            queue_mail(
                 authio_google_subject,
                 authio_google_message,
                 DEFAULT_FROM_EMAIL,
@@ -61,7 +61,7 @@ class ContractDetailsInvestmentPool(CommonDetails):
                 self.admin_address,
                 self.investment_address if self.investment_address else '0x'+'0'*40,
                 self.token_address if self.token_address else '0x'+'0'*40,
-                NETWORKS[self.contract.network.name]['address'] if self.platform_as_admin else '0x'+'0'*40,
+                get_deploy_address(self.contract) if self.platform_as_admin else '0x'+'0'*40,
         ]
 
     def compile(self, _=''):
@@ -69,10 +69,6 @@ class ContractDetailsInvestmentPool(CommonDetails):
         if self.temp_directory:
             print('already compiled')
             return
-        dest, preproc_config = create_directory(
-            self, sour_path='ducx_wish/investment-pool/*',
-            config_name='investment-pool-config.json'
-        )
         preproc_params = {'constants': {}}
 
         preproc_params["constants"]["D_SOFT_CAP_WEI"] = str(self.soft_cap)
@@ -92,14 +88,12 @@ class ContractDetailsInvestmentPool(CommonDetails):
             preproc_params["constants"]["D_MAX_VALUE_WEI"] = str(
                 int(self.max_wei))
         print('params', preproc_params, flush=True)
-        test_investment_pool_params(preproc_config, preproc_params, dest)
-        with open(preproc_config, 'w') as f:
-            f.write(json.dumps(preproc_params))
-        with open(path.join(dest, 'build/contracts/InvestmentPool.json'),
-                  'rb') as f:
-            investment_json = json.loads(f.read().decode('utf-8-sig'))
-        with open(path.join(dest, 'build/InvestmentPool.sol'), 'rb') as f:
-            source_code = f.read().decode('utf-8-sig')
+        artifacts = compile_with_cache(
+            self, 'ducx_wish/investment-pool/*', 'investment-pool-config.json',
+            test_investment_pool_params, preproc_params, preproc_params,
+            'yarn compile', ['InvestmentPool']
+        )
+        investment_json, source_code = artifacts['InvestmentPool']
         self.ducx_contract = create_ethcontract_in_compile(
             investment_json['abi'], investment_json['bytecode'][2:],
             investment_json['compiler']['version'], self.contract, source_code
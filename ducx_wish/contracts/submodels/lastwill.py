@@ -4,11 +4,12 @@ from ethereum import abi
 
 from django.db import models
 from django.db.models import F
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
 from ducx_wish.contracts.submodels.common import *
+from ducx_wish.other.mail_templates import queue_notifications, get_user_lang
 from email_messages import *
 from ducx_wish.settings import LASTWILL_ALIVE_TIMEOUT
 from ducx_wish.consts import NET_DECIMALS, CONTRACT_GAS_LIMIT
@@ -21,9 +22,9 @@ class ContractDetailsLastwill(CommonDetails):
     result_filename = 'build/contracts/LastWillNotify.json'
     user_address = models.CharField(max_length=50, null=True, default=None)
     check_interval = models.IntegerField()
-    active_to = models.DateTimeField()
+    active_to = models.DateTimeField(db_index=True)
     last_check = models.DateTimeField(null=True, default=None)
-    next_check = models.DateTimeField(null=True, default=None)
+    next_check = models.DateTimeField(null=True, default=None, db_index=True)
     ducx_contract = models.ForeignKey(DUCXContract, null=True, default=None)
     email = models.CharField(max_length=256, null=True, default=None)
     btc_key = models.ForeignKey(BtcKey4RSK, null=True, default=None)
@@ -57,27 +58,27 @@ class ContractDetailsLastwill(CommonDetails):
     def make_payment(self, message):
         contract = self.contract
         eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-        wl_address = NETWORKS[self.contract.network.name]['address']
+        wl_address = get_deploy_address(self.contract)
         balance = int(eth_int.eth_getBalance(wl_address), 16)
         gas_limit = CONTRACT_GAS_LIMIT['LASTWILL_PAYMENT']
         gas_price = NET_DECIMALS['ETH_GAS_PRICE']
         if balance < contract.get_details().btc_duty + gas_limit * gas_price:
-            send_mail(
+            queue_mail(
                 'RSK',
                 'No RSK funds ' + contract.network.name,
                 DEFAULT_FROM_EMAIL,
                 [EMAIL_FOR_POSTPONED_MESSAGE]
             )
             return
-        nonce = int(eth_int.eth_getTransactionCount(wl_address, "pending"), 16)
-        signed_data = sign_transaction(
-            wl_address, nonce, gas_limit, self.contract.network.name,
-            value=int(contract.get_details().btc_duty),
-            dest=contract.get_details().ducx_contract.address,
-            gas_price=gas_price
-        )
-        self.ducx_contract.tx_hansh = eth_int.eth_sendRawTransaction(
-            '0x' + signed_data)
+        with reserved_nonce(eth_int, self.contract.network.name, wl_address) as nonce:
+            signed_data = sign_transaction(
+                wl_address, nonce, gas_limit, self.contract.network.name,
+                value=int(contract.get_details().btc_duty),
+                dest=contract.get_details().ducx_contract.address,
+                gas_price=gas_price
+            )
+            self.ducx_contract.tx_hansh = eth_int.eth_sendRawTransaction(
+                '0x' + signed_data)
         self.ducx_contract.save()
 
     def get_arguments(self, *args, **kwargs):
@@ -131,26 +132,19 @@ class ContractDetailsLastwill(CommonDetails):
         self.last_check = timezone.now()
         self.next_check = None
         self.save()
-        heirs = Heir.objects.filter(contract=self.contract)
-        link = NETWORKS[self.ducx_contract.contract.network.name]['link_tx']
-        for heir in heirs:
-            if heir.email:
-                send_mail(
-                    heir_subject,
-                    heir_message.format(
-                            user_address=heir.address,
-                            link_tx=link.format(tx=message['transactionHash'])
-                    ),
-                    DEFAULT_FROM_EMAIL,
-                    [heir.email]
-                )
+        heirs = Heir.objects.filter(contract=self.contract).exclude(email=None).exclude(email='')
+        link_tx = NETWORKS[self.ducx_contract.contract.network.name]['link_tx'].format(tx=message['transactionHash'])
+        # heirs have no profile, they get the language of the contract owner
+        lang = get_user_lang(self.contract.user)
+        queue_notifications('heir_subject', 'heir_message', DEFAULT_FROM_EMAIL, [
+            (heir.email, lang, {'user_address': heir.address, 'link_tx': link_tx}) for heir in heirs
+        ])
         self.contract.state = 'TRIGGERED'
         self.contract.save()
         if self.contract.user.email:
-            send_mail(
-                carry_out_subject, carry_out_message,
-                DEFAULT_FROM_EMAIL, [self.contract.user.email]
-            )
+            queue_notifications('carry_out_subject', 'carry_out_message', DEFAULT_FROM_EMAIL, [
+                (self.contract.user.email, lang, {})
+            ])
 
     def get_gaslimit(self):
         Cg = 1270525
@@ -175,7 +169,6 @@ class ContractDetailsLastwill(CommonDetails):
             self.save()
         super().deploy()
 
-    @blocking
     def i_am_alive(self, message):
         if self.last_press_imalive:
             delta = self.last_press_imalive - timezone.now()
@@ -185,39 +178,38 @@ class ContractDetailsLastwill(CommonDetails):
                 )
         tr = abi.ContractTranslator(self.ducx_contract.abi)
         eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-        address = self.contract.network.deployaddress_set.all()[0].address
-        nonce = int(eth_int.eth_getTransactionCount(address, "pending"), 16)
+        address = get_deploy_address(self.contract)
         gas_limit = CONTRACT_GAS_LIMIT['LASTWILL_COMMON']
-        signed_data = sign_transaction(
-            address, nonce, gas_limit, self.contract.network.name,
-            dest=self.ducx_contract.address,
-            contract_data=binascii.hexlify(
-                    tr.encode_function_call('imAvailable', [])
-                ).decode(),
-        )
-        self.ducx_contract.tx_hash = eth_int.eth_sendRawTransaction(
-            '0x' + signed_data
-        )
+        with reserved_nonce(eth_int, self.contract.network.name, address) as nonce:
+            signed_data = sign_transaction(
+                address, nonce, gas_limit, self.contract.network.name,
+                dest=self.ducx_contract.address,
+                contract_data=binascii.hexlify(
+                        tr.encode_function_call('imAvailable', [])
+                    ).decode(),
+            )
+            self.ducx_contract.tx_hash = eth_int.eth_sendRawTransaction(
+                '0x' + signed_data
+            )
         self.ducx_contract.save()
         self.last_press_imalive = timezone.now()
 
-    @blocking
     def cancel(self, message):
         tr = abi.ContractTranslator(self.ducx_contract.abi)
         eth_int = EthereumProvider().get_provider(network=self.contract.network.name)
-        address = self.contract.network.deployaddress_set.all()[0].address
-        nonce = int(eth_int.eth_getTransactionCount(address, "pending"), 16)
+        address = get_deploy_address(self.contract)
         gas_limit = CONTRACT_GAS_LIMIT['LASTWILL_COMMON']
-        signed_data = sign_transaction(
-            address, nonce,  gas_limit, self.contract.network.name,
-            dest=self.ducx_contract.address,
-            contract_data=binascii.hexlify(
-                    tr.encode_function_call('kill', [])
-                ).decode(),
-        )
-        self.ducx_contract.tx_hash = eth_int.eth_sendRawTransaction(
-            '0x' + signed_data
-        )
+        with reserved_nonce(eth_int, self.contract.network.name, address) as nonce:
+            signed_data = sign_transaction(
+                address, nonce,  gas_limit, self.contract.network.name,
+                dest=self.ducx_contract.address,
+                contract_data=binascii.hexlify(
+                        tr.encode_function_call('kill', [])
+                    ).decode(),
+            )
+            self.ducx_contract.tx_hash = eth_int.eth_sendRawTransaction(
+                '0x' + signed_data
+            )
         self.ducx_contract.save()
 
     def fundsAdded(self, message):
@@ -226,4 +218,17 @@ class ContractDetailsLastwill(CommonDetails):
         ContractDetailsLastwill.objects.select_for_update().filter(
             id=self.id
         ).update(btc_duty=F('btc_duty') - message['value'])
-        take_off_blocking(self.contract.network.name)
+        take_off_blocking(self.contract.network.name, self.contract.id)
+
+
+class LastwillReminder(models.Model):
+    '''
+    reminder already queued for a check, keeps sweeps from sending it twice
+    '''
+    details = models.ForeignKey(ContractDetailsLastwill)
+    next_check = models.DateTimeField()
+    days = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('details', 'next_check', 'days')
@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from ducx_wish.settings import NETWORKS, DEPLOY_LOCKS_DATABASE
+from ducx_wish.deploy.models import DeployAddress, Network
+
+
+def get_deploy_keys(network_name):
+    '''
+    address -> private key of every address the platform deploys from,
+    NETWORKS[network]['deploy_addresses'] extends the default address
+    '''
+    network = NETWORKS[network_name]
+    keys = dict(network.get('deploy_addresses', {}))
+    keys.setdefault(network['address'], network.get('private_key'))
+    return keys
+
+
+def deploy_addresses():
+    '''
+    address locks and nonces are committed on their own connection, a handler
+    transaction rolling back must not undo a lock or a nonce already sent
+    '''
+    return DeployAddress.objects.using(DEPLOY_LOCKS_DATABASE)
+
+
+def deploy_stage_queue(network_name, stage):
+    return '{queue}-{stage}'.format(queue=NETWORKS[network_name]['queue'], stage=stage)
+
+
+def get_deploy_address(contract):
+    return contract.deploy_address or NETWORKS[contract.network.name]['address']
+
+
+def get_deploy_key(contract):
+    return get_deploy_keys(contract.network.name)[get_deploy_address(contract)]
+
+
+def sync_deploy_addresses(network_name):
+    network = Network.objects.get(name=network_name)
+    for address in get_deploy_keys(network_name):
+        DeployAddress.objects.get_or_create(network=network, address=address)
+
+
+def lock_deploy_address(contract):
+    '''
+    locks the address contract is deployed from, a new contract gets the least
+    recently used free address of the pool; returns False when none is free
+    '''
+    network_name = contract.network.name
+    addresses = [contract.deploy_address] if contract.deploy_address else list(get_deploy_keys(network_name))
+    with transaction.atomic(using=DEPLOY_LOCKS_DATABASE):
+        candidates = deploy_addresses().select_for_update(skip_locked=True).filter(
+            network__name=network_name, address__in=addresses
+        )
+        deploy_address = candidates.filter(locked_by=contract.id).first()
+        if deploy_address is None:
+            deploy_address = candidates.filter(locked_by__isnull=True).order_by(
+                F('last_locked').asc(nulls_first=True)
+            ).first()
+        if deploy_address is None:
+            return False
+        deploy_address.locked_by = contract.id
+        deploy_address.last_locked = timezone.now()
+        deploy_address.save(update_fields=['locked_by', 'last_locked'])
+    if contract.deploy_address != deploy_address.address:
+        contract.deploy_address = deploy_address.address
+        contract.save(update_fields=['deploy_address'])
+    return True
+
+
+def reserve_nonce(eth_int, network_name, address):
+    with transaction.atomic(using=DEPLOY_LOCKS_DATABASE):
+        deploy_address = deploy_addresses().select_for_update().filter(
+            network__name=network_name, address=address
+        ).first()
+        if deploy_address is None:
+            print('no deploy address', address, 'in', network_name, 'using node nonce', flush=True)
+            return int(eth_int.eth_getTransactionCount(address, 'pending'), 16)
+        if deploy_address.nonce is None:
+            deploy_address.nonce = int(eth_int.eth_getTransactionCount(address, 'pending'), 16)
+            print('nonce reconciled with node', address, deploy_address.nonce, flush=True)
+        nonce = deploy_address.nonce
+        deploy_address.nonce += 1
+        deploy_address.save(update_fields=['nonce'])
+    return nonce
+
+
+def release_nonce(network_name, address, nonce):
+    with transaction.atomic(using=DEPLOY_LOCKS_DATABASE):
+        if deploy_addresses().select_for_update().filter(
+                network__name=network_name, address=address, nonce=nonce + 1
+        ).update(nonce=nonce):
+            return
+        # later nonces are already taken, next reservation closes the gap from the node
+        deploy_addresses().filter(
+            network__name=network_name, address=address
+        ).update(nonce=None)
+
+
+def forget_nonce(network_name, address):
+    # node disagrees with the stored counter ('nonce too low' and alike)
+    deploy_addresses().filter(network__name=network_name, address=address).update(nonce=None)
+
+
+def reset_nonces(network_name):
+    deploy_addresses().filter(network__name=network_name).update(nonce=None)
+
+
+@contextmanager
+def reserved_nonce(eth_int, network_name, address):
+    '''
+    gives the next nonce of address, it is returned back if the transaction was not sent
+    '''
+    nonce = reserve_nonce(eth_int, network_name, address)
+    try:
+        yield nonce
+    except Exception as e:
+        print('transaction not sent, releasing nonce', nonce, flush=True)
+        if 'nonce' in str(e).lower():
+            forget_nonce(network_name, address)
+        else:
+            release_nonce(network_name, address, nonce)
+        raise
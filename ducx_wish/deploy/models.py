@@ -8,3 +8,6 @@ class DeployAddress(models.Model):
     address = models.CharField(max_length=50)
     locked_by = models.IntegerField(null=True, default=None)
     network = models.ForeignKey(Network, default=1)
+    # next nonce to send from this address, None means it has to be read from the node
+    nonce = models.IntegerField(null=True, default=None)
+    last_locked = models.DateTimeField(null=True, default=None)
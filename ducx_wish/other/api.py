@@ -1,10 +1,9 @@
-from django.core.mail import send_mail
 
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from .models import Sentence
+from .models import Sentence, queue_mail
 from .serializers import SentenceSerializer
 from ducx_wish.permissions import IsStaff, CreateOnly
 from ducx_wish.settings import UNBLOCKING_EMAIL, DEFAULT_FROM_EMAIL
@@ -32,7 +31,7 @@ def send_unblocking_info(request):
     """.format(
         name=name, email=email, telegram=telegram, message=message, page=page
     )
-    send_mail(
+    queue_mail(
         'Request from rocknblock.io contact form',
         text,
         DEFAULT_FROM_EMAIL,
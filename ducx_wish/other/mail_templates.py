@@ -0,0 +1,56 @@
+import importlib
+from functools import lru_cache
+
+from ducx_wish.settings import EMAIL_TEMPLATE_MODULES, EMAIL_DEFAULT_LANG, EMAIL_RENDER_CACHE_SIZE
+from ducx_wish.profile.models import Profile
+from ducx_wish.other.models import OutboxEmail
+
+
+template_modules = {
+    lang: importlib.import_module(module_name) for lang, module_name in EMAIL_TEMPLATE_MODULES.items()
+}
+
+
+@lru_cache(maxsize=None)
+def get_template(name, lang):
+    '''
+    template text for the language, falls back to the default language
+    '''
+    module = template_modules.get(lang)
+    if module is None or not hasattr(module, name):
+        module = template_modules[EMAIL_DEFAULT_LANG]
+    return getattr(module, name)
+
+
+@lru_cache(maxsize=EMAIL_RENDER_CACHE_SIZE)
+def render_cached(name, lang, context):
+    return get_template(name, lang).format(**dict(context))
+
+
+def render_template(name, lang, **context):
+    return render_cached(name, lang, tuple(sorted(context.items())))
+
+
+def get_users_langs(user_ids):
+    langs = dict.fromkeys(user_ids, EMAIL_DEFAULT_LANG)
+    langs.update(Profile.objects.filter(user_id__in=user_ids).values_list('user_id', 'lang'))
+    return langs
+
+
+def get_user_lang(user):
+    return get_users_langs([user.id])[user.id]
+
+
+def queue_notifications(subject_name, message_name, from_email, notifications):
+    '''
+    renders [(email, lang, context), ...] and stores them in the outbox with one insert,
+    equal contexts in the same language are rendered once
+    '''
+    OutboxEmail.objects.bulk_create([
+        OutboxEmail(
+            subject=render_template(subject_name, lang, **context),
+            body=render_template(message_name, lang, **context),
+            from_email=from_email,
+            recipients=[email]
+        ) for email, lang, context in notifications
+    ])
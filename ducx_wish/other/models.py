@@ -1,9 +1,35 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
-from django.core.mail import send_mail
+from django.contrib.postgres.fields import JSONField
 from ducx_wish.settings import DEFAULT_FROM_EMAIL, DEFAULT_TO_EMAIL
 
 
+class OutboxEmail(models.Model):
+    subject = models.TextField()
+    body = models.TextField()
+    html_body = models.TextField(null=True, default=None)
+    from_email = models.CharField(max_length=200)
+    recipients = JSONField(default=[])
+    state = models.CharField(max_length=20, default='queued', db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(null=True, default=None)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, default=None)
+
+
+def queue_mail(subject, message, from_email, recipient_list, html_message=None):
+    '''
+    same arguments as send_mail, the message is sent later by mail_sender.py
+    and is queued only if the surrounding transaction commits
+    '''
+    OutboxEmail.objects.create(
+        subject=subject, body=message, html_body=html_message,
+        from_email=from_email, recipients=list(recipient_list)
+    )
+
+
 class Sentence(models.Model):
     username = models.CharField(max_length=200)
     email = models.CharField(max_length=200)
@@ -14,12 +40,11 @@ class Sentence(models.Model):
         new_obj = not self.id
         super().save(*args, **kwargs)
         if new_obj:
-            send_mail(
+            queue_mail(
                 '{} {} {}'.format(self.contract_name, self.username, self.email),
                 self.message,
                 DEFAULT_FROM_EMAIL,
                 [DEFAULT_TO_EMAIL],
-                fail_silently=True,
             )
 
 
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import json
+import time
+import threading
 import requests
 import sys
-from ducx_wish.settings import NETWORKS
+from ducx_wish.settings import NETWORKS, RPC_TIMEOUT, RPC_RETRIES, RPC_BACKOFF
 
 
 class InterfaceConnectExc(Exception):
@@ -28,18 +30,74 @@ class ParErrorExc(InterfaceErrorExc):
     pass
 
 
-class ParInt:
-    def __init__(self, network=None):
-        if network is None:
-            if len(sys.argv) > 1 and sys.argv[1] in NETWORKS:
-                network = sys.argv[1]
-            else:
-                network = 'DUCATUSX_MAINNET'
-        print('network', network, type(network))
-        self.host = NETWORKS[network]['url']
-        print('parity interface', self.addr, self.port, flush=True)
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_chain_ids = {}
+
+rpc_stats = {}
+_rpc_stats_lock = threading.Lock()
+
+# a timed out send may still have reached the node, resending gives 'known transaction'
+NOT_RETRIED_ON_TIMEOUT = ('eth_sendRawTransaction',)
+
+
+def get_session(url):
+    with _sessions_lock:
+        if url not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Content-Type': 'application/json'})
+            _sessions[url] = session
+        return _sessions[url]
+
+
+def count_rpc_call(url, method, elapsed, error=False):
+    with _rpc_stats_lock:
+        stats = rpc_stats.setdefault((url, method), {'calls': 0, 'errors': 0, 'time': 0.0})
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        if error:
+            stats['errors'] += 1
+
+
+def get_rpc_stats():
+    with _rpc_stats_lock:
+        return {
+            key: dict(value, avg_time=value['time'] / value['calls'])
+            for key, value in rpc_stats.items()
+        }
+
+
+class JsonRpcInterface:
+    connect_exc = InterfaceConnectExc
+    error_exc = InterfaceErrorExc
+    url = None
+
+    def post(self, arguments, method):
+        session = get_session(self.url)
+        for attempt in range(RPC_RETRIES + 1):
+            started = time.time()
+            try:
+                response = session.post(self.url, json=arguments, timeout=RPC_TIMEOUT)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                count_rpc_call(self.url, method, time.time() - started, error=True)
+                retriable = isinstance(e, requests.exceptions.ConnectionError) or \
+                    method not in NOT_RETRIED_ON_TIMEOUT
+                if attempt == RPC_RETRIES or not retriable:
+                    raise self.connect_exc()
+                print('rpc', method, 'failed, retrying:', e, flush=True)
+                time.sleep(RPC_BACKOFF * 2 ** attempt)
+                continue
+            count_rpc_call(self.url, method, time.time() - started)
+            return response.json()
 
     def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
         def f(*args):
             arguments = {
                     'method': method,
@@ -47,21 +105,53 @@ class ParInt:
                     'id': 1,
                     'jsonrpc': '2.0',
             }
-            try:
-                temp = requests.post(
-                        self.host,
-                        json=arguments,
-                        headers={'Content-Type': 'application/json'}
-                )
-            except requests.exceptions.ConnectionError as e:
-                raise ParConnectExc()
-            print('raw response', temp.content, flush=True)
-            result = json.loads(temp.content.decode())
+            result = self.post(arguments, method)
             if result.get('error'):
-                raise ParErrorExc(result['error']['message'])
+                raise self.error_exc(result['error']['message'])
             return result['result']
         return f
 
+    def chain_id(self):
+        if self.url not in _chain_ids:
+            _chain_ids[self.url] = self.eth_chainId()
+        return _chain_ids[self.url]
+
+    def batch(self, *calls):
+        """
+        sends several calls in one request, calls are tuples (method, *params),
+        results are returned in the same order
+        """
+        arguments = [{
+                'method': call[0],
+                'params': call[1:],
+                'id': i,
+                'jsonrpc': '2.0',
+        } for i, call in enumerate(calls)]
+        methods = ','.join(call[0] for call in calls)
+        response = self.post(arguments, 'batch:' + methods)
+        if isinstance(response, dict):
+            raise self.error_exc(response.get('error', {}).get('message', 'batch rejected'))
+        results = sorted(response, key=lambda x: x['id'])
+        for result in results:
+            if result.get('error'):
+                raise self.error_exc(result['error']['message'])
+        return [result['result'] for result in results]
+
+
+class ParInt(JsonRpcInterface):
+    connect_exc = ParConnectExc
+    error_exc = ParErrorExc
+
+    def __init__(self, network=None):
+        if network is None:
+            if len(sys.argv) > 1 and sys.argv[1] in NETWORKS:
+                network = sys.argv[1]
+            else:
+                network = 'DUCATUSX_MAINNET'
+        print('network', network, type(network))
+        self.url = NETWORKS[network]['url']
+        print('parity interface', self.url, flush=True)
+
 
 class NeoInt(ParInt):
     pass
@@ -76,7 +166,10 @@ class InfuraErrorExc(InterfaceErrorExc):
     pass
 
 
-class InfuraInt:
+class InfuraInt(JsonRpcInterface):
+    connect_exc = InfuraConnectExc
+    error_exc = InfuraErrorExc
+
     def __init__(self, network=None):
         if network is None:
             if len(sys.argv) > 1 and sys.argv[1] in NETWORKS:
@@ -94,29 +187,6 @@ class InfuraInt:
 
         print('infura interface', self.url, flush=True)
 
-    def __getattr__(self, method):
-        def f(*args):
-            arguments = {
-                    'method': method,
-                    'params': args,
-                    'id': 1,
-                    'jsonrpc': '2.0',
-            }
-            try:
-                temp = requests.post(
-                        self.url,
-                        json=arguments,
-                        headers={'Content-Type': 'application/json'}
-                )
-            except requests.exceptions.ConnectionError as e:
-                raise InfuraConnectExc()
-            print('raw response', temp.content, flush=True)
-            result = json.loads(temp.content.decode())
-            if result.get('error'):
-                raise InfuraErrorExc(result['error']['message'])
-            return result['result']
-        return f
-
 
 class EthereumProvider:
 
@@ -1,4 +1,4 @@
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 from allauth.account.adapter import DefaultAccountAdapter
 from ducx_wish.settings import DUCATUSX_URL, EMAIL_HOST_USER
 from email_messages import register_subject, register_text
@@ -19,7 +19,7 @@ class SubSiteRegistrationAdapter(DefaultAccountAdapter):
         from_email = EMAIL_HOST_USER
         welcome_head = 'MyWish Platform'
 
-        send_mail(
+        queue_mail(
             register_subject,
             register_text.format(
                 subsite_name=welcome_head,
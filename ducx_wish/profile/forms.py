@@ -1,5 +1,5 @@
 from django import forms
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib.auth.tokens import default_token_generator
@@ -37,7 +37,7 @@ class SubSitePasswordResetForm(PasswordResetForm):
                 from_email = EMAIL_HOST_USER
                 subsite_name = 'MyWish Platform'
 
-                send_mail(
+                queue_mail(
                         password_reset_subject.format(subsite_name=subsite_name),
                         password_reset_text.format(
                                 subsite_name=subsite_name,
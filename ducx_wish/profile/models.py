@@ -47,3 +47,12 @@ class APIToken(models.Model):
 
     class Meta:
         unique_together = ("user", "token")
+
+
+class WSPresence(models.Model):
+    # user has open websockets on this wsdaemon instance
+    user = models.ForeignKey(User)
+    instance = models.CharField(max_length=50, db_index=True)
+
+    class Meta:
+        unique_together = ("user", "instance")
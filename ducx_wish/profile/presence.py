@@ -0,0 +1,54 @@
+import json
+import hashlib
+from collections import defaultdict
+
+import pika
+from django.db import IntegrityError
+
+from ducx_wish.settings import WS_EXCHANGE, WS_LOGOUT_ROUTING_KEY
+from ducx_wish.profile.models import WSPresence
+from ducx_wish.publisher import publish_batch
+
+
+def ws_queue_name(instance):
+    return 'websockets.{instance}'.format(instance=instance)
+
+
+def user_connected(user_id, instance):
+    try:
+        WSPresence.objects.get_or_create(user_id=user_id, instance=instance)
+    except IntegrityError:
+        pass
+
+
+def user_disconnected(user_id, instance):
+    WSPresence.objects.filter(user_id=user_id, instance=instance).delete()
+
+
+def clear_instance(instance):
+    # sockets of a restarted daemon are gone
+    WSPresence.objects.filter(instance=instance).delete()
+
+
+def get_users_instances(user_ids):
+    instances = defaultdict(list)
+    for user_id, instance in WSPresence.objects.filter(user_id__in=user_ids).values_list('user_id', 'instance'):
+        instances[user_id].append(instance)
+    return instances
+
+
+def notify_logout(sender, request, user, **kwargs):
+    # every wsdaemon instance forgets the cached session and closes its sockets,
+    # presence may not list a socket whose connect is still being written
+    if user is None or not request.session.session_key:
+        return
+    body = json.dumps({
+        'user': user.id,
+        'session': hashlib.sha256(request.session.session_key.encode()).hexdigest()
+    })
+    try:
+        publish_batch(
+            WS_LOGOUT_ROUTING_KEY, [(body, pika.BasicProperties(expiration='30000', type='logout'))], WS_EXCHANGE
+        )
+    except Exception as e:
+        print('in logout notification:', e, flush=True)
@@ -5,13 +5,14 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.contrib import messages
 from django.views.generic.base import TemplateResponseMixin, TemplateView, View
 from django.shortcuts import redirect
-from django.core.mail import send_mail
+from ducx_wish.other.models import queue_mail
 from django.http import (
     Http404,
     HttpResponsePermanentRedirect,
     HttpResponseRedirect,
 )
 from django.contrib.sites.shortcuts import get_current_site
+from django.contrib.auth.signals import user_logged_out
 
 from rest_framework.decorators import api_view
 from rest_framework.exceptions import PermissionDenied
@@ -35,6 +36,7 @@ from ducx_wish.contracts.models import Contract
 from ducx_wish.profile.helpers import valid_totp
 from ducx_wish.settings import MY_WISH_URL, SUPPORT_EMAIL, DEFAULT_FROM_EMAIL, WAVES_URL
 from ducx_wish.profile.models import SubSite, UserSiteBalance, APIToken
+from ducx_wish.profile.presence import notify_logout
 
 
 class ConfirmEmailView(TemplateResponseMixin, View):
@@ -244,7 +246,7 @@ def create_api_token(request):
     text = request.data['label']
     api_token = APIToken(user=user, token=token_str, comment=text)
     api_token.save()
-    send_mail(
+    queue_mail(
         'User create api token',
         'User with id={id} {email_info} create token for api'.format(
             id=user.id, email_info='email is {email}'.format(email=user.email)
@@ -305,3 +307,5 @@ def delete_api_tokens(request):
         token.save()
     return Response({"result": "ok"})
 
+
+user_logged_out.connect(notify_logout)
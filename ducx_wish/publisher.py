@@ -0,0 +1,115 @@
+import json
+import queue
+import threading
+
+import pika
+
+from ducx_wish.settings import AMQP_PUBLISHER_POOL_SIZE
+
+
+class PublishError(Exception):
+    pass
+
+
+class Publisher:
+    """
+    long-lived blocking connection with a confirming channel,
+    not thread-safe on its own, use it through publisher_pool
+    """
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+
+    def open_channel(self):
+        if self.channel is None or self.channel.is_closed or self.connection.is_closed:
+            self.close()
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+                'localhost',
+                5672,
+                'ducxwill',
+                pika.PlainCredentials('ducxwill', 'ducxwill'),
+            ))
+            self.channel = self.connection.channel()
+            self.channel.confirm_delivery()
+        return self.channel
+
+    def close(self):
+        try:
+            if self.connection is not None and not self.connection.is_closed:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+
+    def declare(self, channel, routing_key, exchange, queue_arguments=None):
+        if exchange:
+            if ('exchange', exchange) not in self.declared:
+                channel.exchange_declare(exchange=exchange, exchange_type='topic', durable=True)
+                self.declared.add(('exchange', exchange))
+        elif ('queue', routing_key) not in self.declared:
+            channel.queue_declare(
+                queue=routing_key, durable=True, auto_delete=False, exclusive=False, arguments=queue_arguments
+            )
+            self.declared.add(('queue', routing_key))
+
+    def publish(self, routing_key, messages, exchange='', queue_arguments=None):
+        # a stale connection (e.g. closed by the broker after missed heartbeats)
+        # is only noticed on use, so reconnect once before giving up;
+        # confirmed messages are not sent again
+        confirmed = 0
+        for attempt in range(2):
+            try:
+                channel = self.open_channel()
+                self.declare(channel, routing_key, exchange, queue_arguments)
+                for body, properties in messages[confirmed:]:
+                    if not channel.basic_publish(
+                            exchange=exchange, routing_key=routing_key, body=body, properties=properties
+                    ):
+                        raise PublishError('message to {key} was not confirmed'.format(key=routing_key))
+                    confirmed += 1
+                return
+            except (pika.exceptions.AMQPError, PublishError):
+                self.close()
+                if attempt:
+                    raise
+
+
+publisher_pool = queue.LifoQueue()
+publishers_created = 0
+publishers_lock = threading.Lock()
+
+
+def get_publisher():
+    global publishers_created
+    try:
+        return publisher_pool.get_nowait()
+    except queue.Empty:
+        pass
+    with publishers_lock:
+        if publishers_created < AMQP_PUBLISHER_POOL_SIZE:
+            publishers_created += 1
+            return Publisher()
+    return publisher_pool.get()
+
+
+def publish_batch(routing_key, messages, exchange='', queue_arguments=None):
+    """
+    publish [(body, properties), ...] to a durable queue, or to a topic exchange if given,
+    returns after the broker has confirmed every message,
+    queue_arguments must match the ones the queue was declared with
+    """
+    publisher = get_publisher()
+    try:
+        publisher.publish(routing_key, messages, exchange, queue_arguments)
+    finally:
+        publisher_pool.put(publisher)
+
+
+def publish_contract_message(queue_name, contract_id, type):
+    publish_batch(queue_name, [(
+        json.dumps({'status': 'COMMITTED', 'contractId': contract_id}),
+        pika.BasicProperties(type=type),
+    )])
@@ -176,9 +176,17 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 100
 }
 
+# upper bound for the limit query parameter of the contracts list
+CONTRACTS_MAX_PAGE_SIZE = 100
+
 CORS_ORIGIN_ALLOW_ALL = True
 
 SIGNER='127.0.0.1:5000'
+
+# json-rpc calls to nodes: seconds per request, attempts after a connection failure
+RPC_TIMEOUT = 10
+RPC_RETRIES = 3
+RPC_BACKOFF = 0.5
 SOL_PATH = '/var/www/contracts_repos/ducx_wish/contracts/LastWillOraclize.sol'
 ORACLIZE_PROXY = '0xf4c716ec3a201b960ca75a74452e663b00cf58b9'
 
@@ -193,6 +201,9 @@ CONTRACTS_DIR = '/var/www/contracts_repos/'
 # have to be writeable
 CONTRACTS_TEMP_DIR = os.path.join(BASE_DIR, 'temp')
 
+# have to be writeable, compiled templates keyed by template sources and preprocessor params
+CONTRACTS_BUILD_CACHE_DIR = os.path.join(BASE_DIR, 'build_cache')
+
 # MESSAGE_QUEUE = 'notification'
 
 REST_AUTH_SERIALIZERS = {
@@ -234,10 +245,84 @@ UNBLOCKING_EMAIL = 'hello@rocknblock.io'
 
 SHELL_PLUS = 'ptpython'
 
+# receiver dispatcher: handlers run in a worker pool, messages of one contract
+# always go to the same worker so they stay ordered
+RECEIVER_WORKERS = 8
+RECEIVER_PREFETCH = 32
+# messages that can not be handled yet (e.g. deploy address locked) wait in
+# delay queues, the n-th retry waits RECEIVER_RETRY_DELAYS[n] seconds (last one repeats)
+RECEIVER_RETRY_DELAYS = (5, 10, 30, 60)
+# retries of a message whose handler failed, then it goes to the '<queue>-parked' queue
+RECEIVER_FAILURE_RETRIES = 5
+# second connection to the default database for deploy address locks and nonces,
+# see ducx_wish.deploy.helpers.deploy_addresses
+DEPLOY_LOCKS_DATABASE = 'deploy_locks'
+
+# deploy pipeline: each stage has its own queue per network and its own workers,
+# only sign holds the deploy address lock
+DEPLOY_STAGES = ('compile', 'sign', 'broadcast')
+DEPLOY_STAGE_WORKERS = {'compile': 2, 'sign': 1, 'broadcast': 2}
+DEPLOY_BROADCAST_RETRIES = 5
+
+# connections kept open per process for publishing to rabbitmq
+AMQP_PUBLISHER_POOL_SIZE = 4
+
+# contract saves within WS_UPDATE_DEBOUNCE seconds are pushed to websockets as one update,
+# containing only the fields changed since the last push
+WS_UPDATE_DEBOUNCE = 0.5
+WS_DIFF_CACHE_SIZE = 10000
+# seconds the receiver trusts a looked up set of wsdaemon instances of a user
+WS_PRESENCE_CACHE_TIMEOUT = 1
+# wsdaemon instances bind websockets.<instance> queues to this topic exchange
+# with their instance name, publishers route by the instances found in presence
+WS_EXCHANGE = 'websockets'
+# every instance also binds this key, a logout reaches sockets not yet in presence
+WS_LOGOUT_ROUTING_KEY = 'logout'
+WS_PORT = 8078
+WS_MAX_CONNECTIONS = 10000
+# wsdaemon: unacked deliveries in flight, updates queued for a client with a full socket buffer
+WS_PREFETCH = 200
+WS_MAX_PENDING = 100
+# wsdaemon: threads for session lookups, seconds a session is trusted without a lookup
+WS_AUTH_THREADS = 10
+WS_AUTH_CACHE_TIMEOUT = 5 * 60
+WS_AUTH_CACHE_SIZE = 100000
+
+AIRDROP_LOAD_CHUNK = 5000
+AIRDROP_LOAD_MAX_REJECTS = 100
+
+STATISTICS_CACHE_TIMEOUT = 60
+STATISTICS_REQUEST_TIMEOUT = 10
+
+# rates are refreshed by rates_refresher.py every RATES_REFRESH_INTERVAL seconds,
+# processes re-read the shared row at most every RATES_MEMO_TIMEOUT seconds
+RATES_REFRESH_INTERVAL = 60
+RATES_MEMO_TIMEOUT = 10
+RATES_TTL = 5 * 60
+RATES_MAX_STALENESS = 60 * 60
+RATES_REQUEST_TIMEOUT = 10
+
+# mail is queued in the outbox table and sent by mail_sender.py
+EMAIL_OUTBOX_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_OUTBOX_BATCH = 50
+EMAIL_OUTBOX_RATE = 10  # messages per second
+EMAIL_OUTBOX_POLL_INTERVAL = 1
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 60
+# seconds a sender owns claimed messages, longer than a batch takes to send
+EMAIL_OUTBOX_LEASE = 300
+
+# Profile.lang -> module with the subjects and messages of that language
+EMAIL_TEMPLATE_MODULES = {'en': 'email_messages'}
+EMAIL_DEFAULT_LANG = 'en'
+EMAIL_RENDER_CACHE_SIZE = 1000
+
 try:
     from ducx_wish.settings_local import *
 except ImportError as exc:
     print("Can't load local settings")
 
+DATABASES.setdefault(DEPLOY_LOCKS_DATABASE, dict(DATABASES['default'], TEST={'MIRROR': 'default'}))
+
 
 
@@ -1,10 +1,60 @@
 import requests
 import json
 import time
+import threading
 
 from binance.client import Client
+from django.utils import timezone
 
-from ducx_wish.settings import RATES_API_URL
+from ducx_wish.settings import RATES_API_URL, RATES_REQUEST_TIMEOUT, RATES_TTL, RATES_MAX_STALENESS, RATES_MEMO_TIMEOUT
+from ducx_wish.contracts.models import RatesCache
+
+
+rates_memo = {'rates': None, 'checked_at': 0}
+rates_lock = threading.Lock()
+
+
+def fetch_rates():
+    return {
+        'duc_usd_price': json.loads(requests.get(
+            RATES_API_URL.format(fsym='DUC', tsyms='USD'), timeout=RATES_REQUEST_TIMEOUT
+        ).content).get('USD'),
+        'ducx_usd_price': json.loads(requests.get(
+            RATES_API_URL.format(fsym='DUCX', tsyms='USD'), timeout=RATES_REQUEST_TIMEOUT
+        ).content).get('USD'),
+    }
+
+
+def refresh_rates():
+    rates = fetch_rates()
+    if not rates['duc_usd_price'] or not rates['ducx_usd_price']:
+        raise Exception('empty rates received: %s' % rates)
+    RatesCache(updated_at=timezone.now(), **rates).save()
+    return rates
+
+
+def get_rates():
+    with rates_lock:
+        if rates_memo['rates'] and time.time() - rates_memo['checked_at'] < RATES_MEMO_TIMEOUT:
+            return rates_memo['rates']
+
+        cached = RatesCache.objects.first()
+        age = (timezone.now() - cached.updated_at).total_seconds() if cached and cached.updated_at else None
+        if age is not None and age < RATES_TTL:
+            rates = {'duc_usd_price': cached.duc_usd_price, 'ducx_usd_price': cached.ducx_usd_price}
+        else:
+            # refresher is late or not running
+            try:
+                rates = refresh_rates()
+            except Exception as e:
+                print('rates refresh failed', e, flush=True)
+                if age is None or age > RATES_MAX_STALENESS:
+                    raise Exception('rates are not available')
+                rates = {'duc_usd_price': cached.duc_usd_price, 'ducx_usd_price': cached.ducx_usd_price}
+
+        rates_memo['rates'] = rates
+        rates_memo['checked_at'] = time.time()
+        return rates
 
 
 def convert(fsym, tsyms):
@@ -13,8 +63,9 @@ def convert(fsym, tsyms):
     if fsym not in allowed or any([x not in allowed for x in tsyms.split(',')]):
         raise Exception('currency not allowed')
 
-    duc_usd_price = json.loads(requests.get(RATES_API_URL.format(fsym='DUC', tsyms='USD')).content).get('USD')
-    ducx_usd_price = json.loads(requests.get(RATES_API_URL.format(fsym='DUCX', tsyms='USD')).content).get('USD')
+    rates = get_rates()
+    duc_usd_price = rates['duc_usd_price']
+    ducx_usd_price = rates['ducx_usd_price']
 
     if fsym == 'USD' and tsyms == 'DUC':
         amount = 1 / duc_usd_price
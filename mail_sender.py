@@ -0,0 +1,94 @@
+import time
+import datetime
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ducx_wish.settings')
+import django
+
+django.setup()
+
+from django.db import transaction
+from django.utils import timezone
+from django.core.mail import get_connection, EmailMultiAlternatives
+
+from ducx_wish.other.models import OutboxEmail
+from ducx_wish.settings import EMAIL_OUTBOX_BACKEND, EMAIL_OUTBOX_BATCH, EMAIL_OUTBOX_RATE
+from ducx_wish.settings import EMAIL_OUTBOX_POLL_INTERVAL, EMAIL_OUTBOX_MAX_ATTEMPTS, EMAIL_OUTBOX_RETRY_DELAY
+from ducx_wish.settings import EMAIL_OUTBOX_LEASE
+
+
+def build_message(email, connection):
+    message = EmailMultiAlternatives(
+        email.subject, email.body, email.from_email, email.recipients, connection=connection
+    )
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def email_failed(email, err):
+    email.attempts += 1
+    email.last_error = str(err)
+    if email.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.state = 'failed'
+    else:
+        email.state = 'queued'
+        email.next_attempt_at = timezone.now() + datetime.timedelta(
+            seconds=EMAIL_OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1)
+        )
+    email.save(update_fields=['attempts', 'last_error', 'state', 'next_attempt_at'])
+    print('mail', email.id, 'failed', email.attempts, err, flush=True)
+
+
+def claim_batch():
+    '''
+    takes due messages for EMAIL_OUTBOX_LEASE seconds in a short transaction,
+    messages of a sender that died while sending are taken again once the lease ends
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(OutboxEmail.objects.select_for_update(skip_locked=True).filter(
+            state__in=('queued', 'sending'), next_attempt_at__lte=now
+        ).order_by('id')[:EMAIL_OUTBOX_BATCH])
+        OutboxEmail.objects.filter(id__in=[email.id for email in emails]).update(
+            state='sending', next_attempt_at=now + datetime.timedelta(seconds=EMAIL_OUTBOX_LEASE)
+        )
+    return emails
+
+
+def send_batch(connection):
+    '''
+    sends claimed messages over the open connection, returns how many were taken,
+    the result of every message is committed as soon as it is known
+    '''
+    emails = claim_batch()
+    for email in emails:
+        started = time.time()
+        try:
+            # no-op while connected, the backend would otherwise reconnect per message
+            connection.open()
+            build_message(email, connection).send()
+        except Exception as e:
+            # the server may have dropped us, reconnect on the next message
+            connection.close()
+            email_failed(email, e)
+        else:
+            email.state = 'sent'
+            email.sent_at = timezone.now()
+            email.save(update_fields=['state', 'sent_at'])
+        time.sleep(max(0, 1 / EMAIL_OUTBOX_RATE - (time.time() - started)))
+    return len(emails)
+
+
+if __name__ == '__main__':
+    connection = get_connection(EMAIL_OUTBOX_BACKEND)
+    while 1:
+        try:
+            if send_batch(connection):
+                print('mail batch sent', flush=True)
+                continue
+        except Exception as e:
+            print('mail batch failed', e, flush=True)
+        # nothing due, do not hold an idle connection to the server
+        connection.close()
+        time.sleep(EMAIL_OUTBOX_POLL_INTERVAL)
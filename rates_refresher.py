@@ -0,0 +1,19 @@
+import time
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ducx_wish.settings')
+import django
+
+django.setup()
+
+from ducx_wish.settings import RATES_REFRESH_INTERVAL
+from exchange_API import refresh_rates
+
+
+if __name__ == '__main__':
+    while 1:
+        try:
+            print('rates refreshed', refresh_rates(), flush=True)
+        except Exception as e:
+            print('rates refresh failed', e, flush=True)
+        time.sleep(RATES_REFRESH_INTERVAL)
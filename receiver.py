@@ -1,4 +1,5 @@
 import queue
+import time
 import pika
 import os
 import traceback
@@ -6,6 +7,7 @@ import threading
 import json
 import sys
 from types import FunctionType
+from collections import OrderedDict
 import datetime
 import fcntl
 
@@ -15,27 +17,103 @@ django.setup()
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Q
+from django.db import transaction, close_old_connections, DatabaseError, OperationalError, InterfaceError
 from django.db.models.signals import post_save
+from django.core.serializers.json import DjangoJSONEncoder
 
 from ducx_wish.contracts.models import (
     Contract, DUCXContract, TxFail, NeedRequeue, AlreadyPostponed,
-    WhitelistAddress
+    WhitelistAddress, DeployTask, resume_deploy_stages, record_processed_message
 )
 from ducx_wish.contracts.serializers import ContractSerializer
-from ducx_wish.settings import NETWORKS
-from ducx_wish.deploy.models import DeployAddress
+from ducx_wish.settings import NETWORKS, RECEIVER_WORKERS, RECEIVER_PREFETCH, DEPLOY_STAGES, DEPLOY_STAGE_WORKERS
+from ducx_wish.settings import RECEIVER_RETRY_DELAYS, RECEIVER_FAILURE_RETRIES
+from ducx_wish.settings import WS_EXCHANGE, WS_UPDATE_DEBOUNCE, WS_DIFF_CACHE_SIZE, WS_PRESENCE_CACHE_TIMEOUT
+from ducx_wish.deploy.helpers import reset_nonces, sync_deploy_addresses, deploy_stage_queue, deploy_addresses
 from ducx_wish.payments.api import create_payment
 from ducx_wish.profile.models import Profile
+from ducx_wish.profile.presence import get_users_instances
+from ducx_wish.publisher import publish_batch
 from exchange_API import to_wish
 
 
+def retry_queue(queue_name, delay):
+    return '{queue}-retry-{delay}'.format(queue=queue_name, delay=delay)
+
+
+def retry_queue_arguments(queue_name, delay):
+    # nobody consumes a retry queue, expired messages are dead-lettered back to the main one
+    return {
+        'x-message-ttl': delay * 1000,
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': queue_name,
+    }
+
+
+def parked_queue(queue_name):
+    return '{queue}-parked'.format(queue=queue_name)
+
+
+# message types whose contractId is a Contract id, in the others it is a DUCXContract id
+CONTRACT_ID_TYPES = (
+    'launch', 'check_contract', 'cancel', 'confirm_alive', 'contractPayment', 'make_payment',
+    'compile_stage', 'sign_stage', 'broadcast_stage',
+)
+
+
+# DUCXContract id -> Contract id, only found ids are kept, the mapping never changes
+contracts_of_ducx_contracts = {}
+
+
+def contract_of_ducx_contract(ducx_contract_id):
+    contract_id = contracts_of_ducx_contracts.get(ducx_contract_id)
+    if contract_id is None:
+        contract_id = DUCXContract.objects.filter(id=ducx_contract_id).values_list('contract_id', flat=True).first()
+        if contract_id is not None:
+            if len(contracts_of_ducx_contracts) >= 10000:
+                contracts_of_ducx_contracts.clear()
+            contracts_of_ducx_contracts[ducx_contract_id] = contract_id
+    return contract_id
+
+
+class ReceiverWorker(threading.Thread):
+
+    def __init__(self, receiver):
+        super().__init__(daemon=True)
+        self.receiver = receiver
+        self.tasks = queue.Queue()
+
+    def run(self):
+        while 1:
+            delivery_tag, message, properties = self.tasks.get()
+            # a connection broken while waiting must not fail the message
+            close_old_connections()
+            result = self.receiver._process(message, properties)
+            close_old_connections()
+            self.receiver.results.put((delivery_tag, result))
+
+
 class Receiver(threading.Thread):
 
-    def __init__(self, network):
+    def __init__(self, network, stage=None):
         super().__init__()
         self.network = network
+        # deploy pipeline stage consumed by this receiver, None for the main queue
+        self.stage = stage
+        if stage is None:
+            self.queue = NETWORKS[network]['queue']
+        else:
+            self.queue = deploy_stage_queue(network, stage)
+        # acks must be sent from the consuming thread, workers report here
+        self.results = queue.Queue()
+        self.workers = []
 
     def run(self):
+        if self.stage is None:
+            sync_deploy_addresses(self.network)
+            # transactions could be sent while the receiver was down
+            reset_nonces(self.network)
+            resume_deploy_stages(self.network)
         connection = pika.BlockingConnection(pika.ConnectionParameters(
             'localhost',
             5672,
@@ -47,18 +125,76 @@ class Receiver(threading.Thread):
         channel = connection.channel()
 
         channel.queue_declare(
-                queue=NETWORKS[self.network]['queue'],
+                queue=self.queue,
                 durable=True,
                 auto_delete=False,
                 exclusive=False
         )
+        for delay in RECEIVER_RETRY_DELAYS:
+            channel.queue_declare(
+                    queue=retry_queue(self.queue, delay),
+                    durable=True,
+                    auto_delete=False,
+                    exclusive=False,
+                    arguments=retry_queue_arguments(self.queue, delay)
+            )
+        channel.basic_qos(
+                prefetch_count=NETWORKS[self.network].get('prefetch', RECEIVER_PREFETCH)
+        )
+
+        if self.stage is None:
+            workers_count = NETWORKS[self.network].get('workers', RECEIVER_WORKERS)
+        else:
+            workers_count = DEPLOY_STAGE_WORKERS[self.stage]
+        self.workers = [ReceiverWorker(self) for _ in range(workers_count)]
+        for worker in self.workers:
+            worker.start()
+
         channel.basic_consume(
                 self.callback,
-                queue=NETWORKS[self.network]['queue']
+                queue=self.queue
         )
 
-        print('receiver start ', self.network, flush=True)
-        channel.start_consuming()
+        print('receiver start ', self.queue, 'workers', workers_count, flush=True)
+        while 1:
+            connection.process_data_events(time_limit=0.1)
+            self._flush_results(channel)
+
+    def _flush_results(self, channel):
+        while 1:
+            try:
+                delivery_tag, result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if result == 'ack':
+                channel.basic_ack(delivery_tag=delivery_tag)
+            elif result == 'requeue':
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            else:
+                # undecodable message, an unacked one would hold a prefetch slot until reconnect
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
+    @staticmethod
+    def _ordering_key(message, properties):
+        # messages of one contract must be handled in order, others may run in parallel;
+        # commands name the Contract and events the DUCXContract, both are keyed by the Contract
+        if message.get('contractId') is not None and properties.type in CONTRACT_ID_TYPES:
+            return 'contract:{}'.format(message['contractId'])
+        for field in ('contractId', 'crowdsaleId'):
+            if message.get(field) is not None:
+                try:
+                    contract_id = contract_of_ducx_contract(message[field])
+                except Exception as e:
+                    # runs in the consuming thread, which must survive a database error
+                    print('ordering key lookup failed', e, flush=True)
+                    close_old_connections()
+                    break
+                if contract_id is not None:
+                    return 'contract:{}'.format(contract_id)
+        for field in ('contractId', 'crowdsaleId', 'id', 'transactionHash', 'userId'):
+            if message.get(field) is not None:
+                return '{}:{}'.format(field, message[field])
+        return properties.type
 
     def payment(self, message):
         print('payment message', flush=True)
@@ -101,7 +237,7 @@ class Receiver(threading.Thread):
         contract.state = 'KILLED'
         contract.save()
         network = contract.network
-        DeployAddress.objects.filter(network=network, locked_by=contract.id).update(locked_by=None)
+        deploy_addresses().filter(network=network, locked_by=contract.id).update(locked_by=None)
         print('killed ok', flush=True)
 
     def checked(self, message):
@@ -139,18 +275,39 @@ class Receiver(threading.Thread):
         print('launch message', flush=True)
         try:
             contract_details = Contract.objects.get(id=message['contractId']).get_details()
-            contract_details.deploy()
         except ObjectDoesNotExist:
             # only when contract removed manually
             print('no contract, ignoging')
             return
-        try:
-            contract_details.refresh_from_db()
-        except:
-            import time
-            time.sleep(0.5)
+        contract_details.start_deploy()
         print('launch ok', flush=True)
 
+    def _deploy_task(self, message, stage):
+        task = DeployTask.objects.select_related('contract').filter(
+            contract_id=message['contractId'], stage=stage
+        ).first()
+        if task is None:
+            print(stage, 'stage message ignored, contract', message['contractId'], 'is not at it', flush=True)
+        return task
+
+    def compile_stage(self, message):
+        task = self._deploy_task(message, 'compile')
+        if task:
+            task.contract.get_details().compile_stage()
+            print('compile stage ok', flush=True)
+
+    def sign_stage(self, message):
+        task = self._deploy_task(message, 'sign')
+        if task:
+            task.contract.get_details().deploy()
+            print('sign stage ok', flush=True)
+
+    def broadcast_stage(self, message):
+        task = self._deploy_task(message, 'broadcast')
+        if task:
+            task.contract.get_details().broadcast(task)
+            print('broadcast stage ok', flush=True)
+
     def ownershipTransferred(self, message):
         print('ownershipTransferred message')
         contract = DUCXContract.objects.get(id=message['crowdsaleId']).contract
@@ -258,6 +415,17 @@ class Receiver(threading.Thread):
         print('received', body, properties, method, flush=True)
         try:
             message = json.loads(body.decode())
+        except Exception:
+            print('\n'.join(traceback.format_exception(*sys.exc_info())),
+                  flush=True)
+            self.results.put((method.delivery_tag, 'reject'))
+            return
+        key = self._ordering_key(message, properties)
+        worker = self.workers[hash(key) % len(self.workers)]
+        worker.tasks.put((method.delivery_tag, message, properties))
+
+    def _process(self, message, properties):
+        try:
             if message.get('status', '') == 'COMMITTED' or properties.type in ('airdrop', 'finalized'):
                 write_flags = fcntl.fcntl(sys.stdout, fcntl.F_GETFL)
                 write_blocking = write_flags & os.O_NONBLOCK
@@ -266,17 +434,95 @@ class Receiver(threading.Thread):
                           write_blocking, flush=True
                           )
                     fcntl.fcntl(1, fcntl.F_SETFL, 0)
-                getattr(self, properties.type, self.unknown_handler)(message)
+                handler = getattr(self, properties.type, self.unknown_handler)
+                if message.get('transactionHash'):
+                    self._handle_once(handler, message, properties)
+                else:
+                    handler(message)
         except (TxFail, AlreadyPostponed):
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return 'ack'
         except NeedRequeue:
-            print('requeueing message', flush=True)
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return self._delay(message, properties)
+        except (OperationalError, InterfaceError):
+            # lost or restarted database, not a failure of the message itself
+            print('\n'.join(traceback.format_exception(*sys.exc_info())), flush=True)
+            close_old_connections()
+            return self._delay(message, properties)
         except Exception as e:
             print('\n'.join(traceback.format_exception(*sys.exc_info())),
                   flush=True)
-        else:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            failures = (properties.headers or {}).get('x-failures', 0) + 1
+            if failures > RECEIVER_FAILURE_RETRIES:
+                return self._park(message, properties, e)
+            return self._delay(message, properties, failures)
+        return 'ack'
+
+    def _delay(self, message, properties, failures=None):
+        '''
+        moves the message to a retry queue instead of requeueing it at once,
+        the waiting time grows with the number of retries
+        '''
+        headers = dict(properties.headers or {})
+        retries = headers.get('x-retries', 0)
+        delay = RECEIVER_RETRY_DELAYS[min(retries, len(RECEIVER_RETRY_DELAYS) - 1)]
+        headers['x-retries'] = retries + 1
+        if failures is not None:
+            headers['x-failures'] = failures
+        try:
+            publish_batch(retry_queue(self.queue, delay), [(
+                json.dumps(message),
+                pika.BasicProperties(type=properties.type, headers=headers),
+            )], queue_arguments=retry_queue_arguments(self.queue, delay))
+        except Exception:
+            print('\n'.join(traceback.format_exception(*sys.exc_info())), flush=True)
+            print('requeueing message', flush=True)
+            return 'requeue'
+        print('message delayed for', delay, 'seconds, retry', retries + 1, flush=True)
+        return 'ack'
+
+    def _park(self, message, properties, error):
+        '''
+        a message still failing after RECEIVER_FAILURE_RETRIES is kept in the parked
+        queue for inspection, it can be moved back to the main queue by hand
+        '''
+        headers = dict(properties.headers or {}, **{'x-error': str(error)})
+        try:
+            publish_batch(parked_queue(self.queue), [(
+                json.dumps(message), pika.BasicProperties(type=properties.type, headers=headers),
+            )])
+        except Exception:
+            print('\n'.join(traceback.format_exception(*sys.exc_info())), flush=True)
+            return 'requeue'
+        print('message parked', properties.type, message, flush=True)
+        return 'ack'
+
+    def _handle_once(self, handler, message, properties):
+        '''
+        runs the handler of a blockchain event in one transaction with its ledger record,
+        a redelivered event finds the record and is acked without running again;
+        address locks and nonces are committed apart (see deploy_addresses)
+        '''
+        error = None
+        with transaction.atomic():
+            record = record_processed_message(self.network, properties.type, message)
+            if record is None:
+                print('duplicate', properties.type, message['transactionHash'], 'ignored', flush=True)
+                return
+            try:
+                handler(message)
+            except (NeedRequeue, DatabaseError):
+                # nothing was done yet, or the database aborted the transaction:
+                # roll back the record too so the retry is not skipped
+                raise
+            except (TxFail, AlreadyPostponed) as e:
+                error = e
+            except Exception as e:
+                # changes made before a failure (e.g. postponing) are kept as before,
+                # the record is not, so the retry runs the handler again
+                record.delete()
+                error = e
+        if error is not None:
+            raise error
 
     def unknown_handler(self, message):
         print('unknown message', message, flush=True)
@@ -379,10 +625,19 @@ class WSInterface(threading.Thread):
     def __init__(self):
         super().__init__()
         self.interthread_queue = queue.Queue()
+        # contract id -> time when its coalesced update is sent
+        self.pending_contracts = OrderedDict()
+        # contract id -> last representation sent, to push only changed fields
+        self.last_sent = OrderedDict()
+        # user id -> (wsdaemon instances holding the user's sockets, time of lookup)
+        self.presence = {}
 
     def send(self, user, message, data):
         self.interthread_queue.put({'user': user, 'msg': message, 'data': data})
 
+    def send_contract(self, contract_id):
+        self.interthread_queue.put({'contract': contract_id})
+
     def run(self):
         connection = pika.BlockingConnection(pika.ConnectionParameters(
                 '127.0.0.1',
@@ -392,17 +647,78 @@ class WSInterface(threading.Thread):
                 heartbeat_interval=0,
         ))
         self.channel = connection.channel()
-        self.channel.queue_declare(queue='websockets', durable=True, auto_delete=False, exclusive=False)
+        self.channel.exchange_declare(exchange=WS_EXCHANGE, exchange_type='topic', durable=True)
         while 1:
-            message = self.interthread_queue.get()
-            user = message.pop('user')
+            timeout = None
+            if self.pending_contracts:
+                timeout = max(next(iter(self.pending_contracts.values())) - time.time(), 0)
+            try:
+                message = self.interthread_queue.get(timeout=timeout)
+            except queue.Empty:
+                message = None
+            if message is not None and 'contract' in message:
+                # saves within the window are merged into the first one
+                self.pending_contracts.setdefault(message['contract'], time.time() + WS_UPDATE_DEBOUNCE)
+            elif message is not None:
+                user = message.pop('user')
+                try:
+                    self.publish(user, message)
+                except Exception as e:
+                    print('in user update:', user, e, flush=True)
+                    close_old_connections()
+            self.flush_contracts()
+
+    def get_instances(self, user):
+        instances, checked_at = self.presence.get(user, (None, 0))
+        if time.time() - checked_at > WS_PRESENCE_CACHE_TIMEOUT:
+            if len(self.presence) > WS_DIFF_CACHE_SIZE:
+                self.presence = {}
+            instances = get_users_instances([user])[user]
+            self.presence[user] = instances, time.time()
+        return instances
+
+    def publish(self, user, message, instances=None):
+        if instances is None:
+            instances = self.get_instances(user)
+        body = json.dumps(message)
+        for instance in instances:
             self.channel.basic_publish(
-                    exchange='',
-                    routing_key='websockets',
-                    body=json.dumps(message),
+                    exchange=WS_EXCHANGE,
+                    routing_key=instance,
+                    body=body,
                     properties=pika.BasicProperties(expiration='30000', type=str(user)),
             )
 
+    def flush_contracts(self):
+        now = time.time()
+        while self.pending_contracts and next(iter(self.pending_contracts.values())) <= now:
+            contract_id, _ = self.pending_contracts.popitem(last=False)
+            try:
+                self.publish_contract(contract_id)
+            except Exception as e:
+                print('in contract update:', contract_id, e, flush=True)
+                close_old_connections()
+
+    def publish_contract(self, contract_id):
+        contract = Contract.objects.select_related('user', 'network').filter(id=contract_id).first()
+        instances = self.get_instances(contract.user.id) if contract is not None else []
+        if not instances:
+            # nobody to push to, the next push after reconnect is a full one
+            self.last_sent.pop(contract_id, None)
+            return
+        contract_data = json.loads(json.dumps(ContractSerializer().to_representation(contract), cls=DjangoJSONEncoder))
+        last_data = self.last_sent.pop(contract_id, None)
+        self.last_sent[contract_id] = contract_data
+        if len(self.last_sent) > WS_DIFF_CACHE_SIZE:
+            self.last_sent.popitem(last=False)
+        if last_data is None:
+            self.publish(contract.user.id, {'msg': 'update_contract', 'data': contract_data}, instances)
+            return
+        changed = {key: value for key, value in contract_data.items() if last_data.get(key) != value}
+        if not changed:
+            return
+        changed['id'] = contract_id
+        self.publish(contract.user.id, {'msg': 'update_contract', 'data': changed, 'partial': True}, instances)
 
 
 """
@@ -423,15 +739,9 @@ def save_profile(sender, instance, **kwargs):
 
 
 def save_contract(sender, instance, **kwargs):
-    try:
-        contract_data = ContractSerializer().to_representation(instance)
-        ws_interface.send(
-                instance.user.id,
-                'update_contract',
-                contract_data,
-        )
-    except Exception as e:
-        print('in save contract callback:', e)
+    contract_id = instance.id
+    # serialized by ws_interface once the burst of saves is over
+    transaction.on_commit(lambda: ws_interface.send_contract(contract_id))
 
 
 post_save.connect(save_contract, sender=Contract)
@@ -445,6 +755,8 @@ ws_interface.start()
 for net in nets:
     rec = Receiver(net)
     rec.start()
+    for stage in DEPLOY_STAGES:
+        Receiver(net, stage).start()
 
 
 
@@ -0,0 +1,93 @@
+'''
+opens many sockets of one user to a running wsdaemon and floods its exchange,
+some sockets stop reading so the daemon has to pause them and drop them after
+WS_MAX_PENDING buffered updates:
+
+python ws_load_test.py <sessionid cookie> <user id> --sockets 1000 --slow 50 --messages 20000
+'''
+import sys
+import json
+import time
+import argparse
+
+import pika
+from twisted.internet import reactor
+from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory, connectWS
+
+parser = argparse.ArgumentParser()
+parser.add_argument('session')
+parser.add_argument('user', type=int)
+parser.add_argument('--url', default='ws://127.0.0.1:8078')
+parser.add_argument('--instance', default='default')
+parser.add_argument('--sockets', type=int, default=100)
+parser.add_argument('--slow', type=int, default=10)
+parser.add_argument('--messages', type=int, default=10000)
+parser.add_argument('--size', type=int, default=2048)
+parser.add_argument('--timeout', type=int, default=60)
+args = parser.parse_args()
+
+stats = {'opened': 0, 'received': 0, 'closed_fast': 0, 'closed_slow': 0}
+started = {}
+
+
+class LoadClient(WebSocketClientProtocol):
+    slow = False
+
+    def onOpen(self):
+        stats['opened'] += 1
+        if self.slow:
+            # stop reading, the daemon sees a full socket buffer
+            self.transport.pauseProducing()
+        if stats['opened'] == args.sockets:
+            print('all sockets open, flooding', flush=True)
+            reactor.callInThread(flood)
+
+    def onMessage(self, payload, isBinary):
+        stats['received'] += 1
+
+    def onClose(self, wasClean, code, reason):
+        stats['closed_slow' if self.slow else 'closed_fast'] += 1
+
+
+def flood():
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+            '127.0.0.1',
+            5672,
+            'ducxwill',
+            pika.PlainCredentials('ducxwill', 'ducxwill'),
+            heartbeat_interval=0
+    ))
+    channel = connection.channel()
+    channel.exchange_declare(exchange='websockets', exchange_type='topic', durable=True)
+    body = json.dumps({'id': 0, 'partial': True, 'padding': 'x' * args.size})
+    started['time'] = time.time()
+    for _ in range(args.messages):
+        channel.basic_publish(
+                exchange='websockets',
+                routing_key=args.instance,
+                body=body,
+                properties=pika.BasicProperties(expiration='30000', type=str(args.user)),
+        )
+    connection.close()
+    print('published', args.messages, 'in', round(time.time() - started['time'], 2), 's', flush=True)
+
+
+def report():
+    fast = args.sockets - args.slow
+    elapsed = time.time() - started.get('time', time.time())
+    print(json.dumps(dict(
+        stats,
+        expected_fast=fast * args.messages,
+        seconds=round(elapsed, 2),
+        delivered_per_second=round(stats['received'] / elapsed) if elapsed else None,
+    ), indent=2), flush=True)
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    for i in range(args.sockets):
+        factory = WebSocketClientFactory(args.url, headers={'Cookie': 'sessionid=' + args.session})
+        factory.protocol = type('Client', (LoadClient,), {'slow': i < args.slow})
+        connectWS(factory)
+    reactor.callLater(args.timeout, report)
+    reactor.run()
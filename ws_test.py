@@ -13,13 +13,14 @@ connection = pika.BlockingConnection(pika.ConnectionParameters(
 
 channel = connection.channel()
 
-channel.queue_declare(queue='websockets', durable=True, auto_delete=False, exclusive=False)
+instance = sys.argv[3] if len(sys.argv) > 3 else 'default'
+channel.exchange_declare(exchange='websockets', exchange_type='topic', durable=True)
 
 
 
 channel.basic_publish(
-        exchange='',
-        routing_key='websockets',
+        exchange='websockets',
+        routing_key=instance,
         body=sys.argv[2],
         properties=pika.BasicProperties(expiration='30000', type=sys.argv[1]),
 )
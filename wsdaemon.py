@@ -1,9 +1,12 @@
 import sys 
 import os
 import json
+import time
+import hashlib
+from collections import deque
 from urllib.parse import urlparse
-from twisted.internet import reactor, protocol, defer, task
-from twisted.python import log 
+from twisted.internet import reactor, protocol, defer, task, threads
+from twisted.python import log, failure
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
 from autobahn.websocket.types import ConnectionDeny
 import pika
@@ -17,37 +20,56 @@ from django.http.cookie import parse_cookie
 from django.contrib.sessions.models import Session
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from ducx_wish.settings import WS_EXCHANGE, WS_PORT, WS_MAX_CONNECTIONS, WS_PREFETCH, WS_MAX_PENDING
+from ducx_wish.settings import WS_AUTH_THREADS, WS_AUTH_CACHE_TIMEOUT, WS_AUTH_CACHE_SIZE, WS_LOGOUT_ROUTING_KEY
+from ducx_wish.profile.presence import user_connected, user_disconnected, clear_instance, ws_queue_name
 
 class WSP(WebSocketServerProtocol):
     user = None
+    session = None
     
     def check_origin(self, origin):
         if origin not in ('http://dev.mywish.io', 'http://contracts.mywish.io'):
             raise ConnectionDeny(404)
 
     def check_auth(self, cookie):
-        session_key = cookie.get(settings.SESSION_COOKIE_NAME, '') 
-        try:
-            session = Session.objects.get(session_key=session_key)
-            user_id = session.get_decoded().get('_auth_user_id')
-            self.user = User.objects.get(id=user_id, is_active=True)
-        except:
+        session_key = cookie.get(settings.SESSION_COOKIE_NAME, '')
+        if not session_key:
             raise ConnectionDeny(403)
 
+        def authorized(user):
+            self.user = user
+            self.session = session_hash(session_key)
+
+        def denied(failure):
+            raise ConnectionDeny(403)
+
+        return get_session_user(session_key).addCallbacks(authorized, denied)
+
     def onConnect(self, request):
         origin = request.headers.get('origin', '') 
 #        self.check_origin(origin)
         cookie = parse_cookie(request.headers.get('cookie', ''))
-        self.check_auth(cookie)
-        return super().onConnect(request)
+        # the handshake completes once the deferred fires
+        return self.check_auth(cookie)
 
     def onOpen(self):
         if self.user.id in self.factory.connections_dict.keys():
             self.factory.connections_dict[self.user.id].append(self)
         else:
             self.factory.connections_dict[self.user.id] = [self]
+            write_presence(user_connected, self.user.id, self.factory.instance)
         self.factory.pings_lost[self.peer] = 0
         self.run = True
+        # the transport pauses us when its write buffer is full
+        self.paused = False
+        self.pending = deque()
+        try:
+            self.transport.registerProducer(self, True)
+        except RuntimeError:
+            pass
         self.doPing()
 
     def onMessage(self, payload, isBinary):
@@ -55,8 +77,11 @@ class WSP(WebSocketServerProtocol):
 
     def onClose(self, wasClean, code, reason):
         self.run = False
-        if self.user and self in self.factory.connections_dict[self.user.id]:
+        if self.user and self in self.factory.connections_dict.get(self.user.id, []):
             self.factory.connections_dict[self.user.id].remove(self)
+            if not self.factory.connections_dict[self.user.id]:
+                del self.factory.connections_dict[self.user.id]
+                write_presence(user_disconnected, self.user.id, self.factory.instance)
         self.factory.pings_lost.pop(self.peer, None)
 
     def doPing(self):
@@ -72,35 +97,158 @@ class WSP(WebSocketServerProtocol):
     def onPong(self, payload):
         self.factory.pings_lost[self.peer] = 0
 
+    def send_update(self, body):
+        if not self.paused:
+            self.sendMessage(body, False)
+            return
+        if len(self.pending) >= WS_MAX_PENDING:
+            # updates may be partial, so a client that missed some must reconnect and reload
+            print('dropping slow client', self.peer, flush=True)
+            self.pending.clear()
+            self.dropConnection(abort=True)
+            return
+        self.pending.append(body)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.pending and not self.paused:
+            self.sendMessage(self.pending.popleft(), False)
+
+    def stopProducing(self):
+        self.pending.clear()
+
+
+
+
+# session key hash -> (user, expiration time)
+auth_cache = {}
+# session key hash -> deferreds waiting for a lookup already running
+auth_pending = {}
+# user id -> last presence write of the user, see write_presence
+presence_writes = {}
+
+
+def session_hash(session_key):
+    return hashlib.sha256(session_key.encode()).hexdigest()
+
+
+def load_session_user(session_key):
+    # runs in the reactor thread pool
+    close_old_connections()
+    session = Session.objects.get(session_key=session_key, expire_date__gt=timezone.now())
+    user_id = session.get_decoded().get('_auth_user_id')
+    return User.objects.get(id=user_id, is_active=True)
+
 
+def get_session_user(session_key):
+    key = session_hash(session_key)
+    user, expires = auth_cache.get(key, (None, 0))
+    if user is not None and expires > time.time():
+        return defer.succeed(user)
+
+    d = defer.Deferred()
+    if key in auth_pending:
+        auth_pending[key].append(d)
+        return d
+    auth_pending[key] = [d]
+
+    def done(result):
+        if not isinstance(result, failure.Failure):
+            if len(auth_cache) >= WS_AUTH_CACHE_SIZE:
+                auth_cache.clear()
+            auth_cache[key] = result, time.time() + WS_AUTH_CACHE_TIMEOUT
+        for waiting in auth_pending.pop(key):
+            if isinstance(result, failure.Failure):
+                waiting.errback(result)
+            else:
+                waiting.callback(result)
+
+    threads.deferToThread(load_session_user, session_key).addBoth(done)
+    return d
+
+
+def write_presence(write, user_id, instance):
+    '''
+    presence writes of one user run one after another in the pool, otherwise the delete
+    of a closed socket could land after the insert of a quick reconnect
+    '''
+    d = defer.Deferred()
+    previous = presence_writes.get(user_id)
+    presence_writes[user_id] = d
+
+    def start(_=None):
+        threads.deferToThread(write, user_id, instance).chainDeferred(d)
+
+    if previous is None:
+        start()
+    else:
+        previous.addBoth(start)
+
+    def done(result):
+        if isinstance(result, failure.Failure):
+            print('presence write failed', user_id, result.getErrorMessage(), flush=True)
+        if presence_writes.get(user_id) is d:
+            del presence_writes[user_id]
+
+    d.addBoth(done)
+
+
+def logout(proto_dict, body):
+    message = json.loads(body.decode())
+    auth_cache.pop(message['session'], None)
+    for c in list(proto_dict.get(message['user'], [])):
+        if c.session == message['session']:
+            c.sendClose()
 
 
 @defer.inlineCallbacks
-def run(connection, proto_dict):
+def run(connection, proto_dict, instance):
+    queue_name = ws_queue_name(instance)
     channel = yield connection.channel()
-    queue = yield channel.queue_declare(queue='websockets', durable=True, auto_delete=False, exclusive=False)
-    queue_object, consumer_tag = yield channel.basic_consume(queue='websockets', no_ack=True)
-    l = task.LoopingCall(read, queue_object, proto_dict)
-    l.start(0.01)
+    yield channel.exchange_declare(exchange=WS_EXCHANGE, exchange_type='topic', durable=True)
+    queue = yield channel.queue_declare(queue=queue_name, durable=True, auto_delete=False, exclusive=False)
+    yield channel.queue_bind(queue=queue_name, exchange=WS_EXCHANGE, routing_key=instance)
+    yield channel.queue_bind(queue=queue_name, exchange=WS_EXCHANGE, routing_key=WS_LOGOUT_ROUTING_KEY)
+    yield channel.basic_qos(prefetch_count=WS_PREFETCH)
+    queue_object, consumer_tag = yield channel.basic_consume(queue=queue_name, no_ack=False)
+    while 1:
+        ch, method, properties, body = yield queue_object.get()
+        try:
+            if properties.type == 'logout':
+                logout(proto_dict, body)
+            else:
+                fan_out(proto_dict, int(properties.type), body)
+        except Exception as e:
+            print('fan out failed', e, flush=True)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def fan_out(proto_dict, user, body):
+    # sends are buffered by the transports, nothing waits for a client here
+    for c in list(proto_dict.get(user, [])):
+        c.send_update(body)
 
-@defer.inlineCallbacks
-def read(queue_object, proto_dict):
-    ch, method, properties, body = yield queue_object.get()
-    user = int(properties.type)
-    print('sending to', user)
-    for c in proto_dict.get(user, []):
-        yield c.sendMessage(body, False)
-    print('sended to', user)
 
 if __name__ == '__main__':
     log.startLogging(sys.stdout)
-    factory = WebSocketServerFactory("ws://127.0.0.1:8078")
+    # several daemons may run side by side (one per core or node), each with its own
+    # name, port and queue; a front proxy keeps a user's sockets on one of them
+    instance = sys.argv[1] if len(sys.argv) > 1 else 'default'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else WS_PORT
+    clear_instance(instance)
+    reactor.addSystemEventTrigger('before', 'shutdown', clear_instance, instance)
+    factory = WebSocketServerFactory("ws://127.0.0.1:{port}".format(port=port))
+    factory.instance = instance
+    reactor.suggestThreadPoolSize(WS_AUTH_THREADS)
     factory.protocol = WSP 
-    factory.setProtocolOptions(maxConnections=10000)
+    factory.setProtocolOptions(maxConnections=WS_MAX_CONNECTIONS)
     factory.connections_dict = {}
     factory.pings_lost = {}
 
-    reactor.listenTCP(8078, factory)
+    reactor.listenTCP(port, factory)
     cc = protocol.ClientCreator(
         reactor,
         twisted_connection.TwistedProtocolConnection,
@@ -114,5 +262,5 @@ if __name__ == '__main__':
     )
     d = cc.connectTCP('127.0.0.1', 5672)
     d.addCallback(lambda protocol: protocol.ready)
-    d.addCallback(run, factory.connections_dict)
+    d.addCallback(run, factory.connections_dict, instance)
     reactor.run()